@@ -0,0 +1,170 @@
+"""
+Local stand-ins for the tracking service and the GraphHopper /match
+endpoint, to benchmark the pipeline without the production services.
+
+The synthetic city is a grid of streets with a block length of about
+100 m. Every track rides along the streets at 1 Hz with GPS noise and
+stops at some intersections. The fake /match endpoint returns the
+intersections that the GPS points pass, like a map matched path.
+
+Run from the repository root, e.g. to try process.py against it:
+
+    python -m benchmarks.fake_services --port 8765 --tracks 1000
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import random
+import re
+import socket
+import time
+import zlib
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+# Grid of the synthetic city, 0.001 degrees are about 111 m north-south and 70 m east-west in Dresden
+ORIGIN = (13.70, 51.03)
+GRID_STEP = 0.001
+GRID_SIZE = 40
+BIKE_TYPES = ["CITYBIKE", "RACINGBIKE", "EBIKE", "CARGOBIKE"]
+METERS_PER_DEGREE = 111320
+
+def grid_point(x, y):
+    return ORIGIN[0] + x * GRID_STEP, ORIGIN[1] + y * GRID_STEP
+
+def track_csv(pk, points_per_track):
+    """
+    Return the GPS CSV of the synthetic track with the given pk. The tracks
+    are deterministic, the length varies around points_per_track.
+    """
+    rng = random.Random(pk)
+    x, y = rng.randrange(GRID_SIZE), rng.randrange(GRID_SIZE)
+    target_points = max(2, int(rng.uniform(0.5, 1.5) * points_per_track))
+    speed = rng.uniform(3, 8)
+    timestamp = 1700000000000 + pk * 1000
+    rows = ["timestamp,latitude,longitude,speed,accuracy"]
+    while len(rows) <= target_points:
+        dx, dy = rng.choice([(1, 0), (-1, 0), (0, 1), (0, -1)])
+        if not (0 <= x + dx < GRID_SIZE and 0 <= y + dy < GRID_SIZE):
+            continue
+        start_lng, start_lat = grid_point(x, y)
+        end_lng, end_lat = grid_point(x + dx, y + dy)
+        length = math.hypot((end_lng - start_lng) * METERS_PER_DEGREE * math.cos(math.radians(start_lat)), (end_lat - start_lat) * METERS_PER_DEGREE)
+        steps = max(1, round(length / speed))
+        # Wait at some traffic lights
+        waiting = rng.randint(5, 30) if rng.random() < 0.2 else 0
+        for step in range(steps + waiting):
+            fraction = min(step, steps) / steps
+            lng = start_lng + (end_lng - start_lng) * fraction + rng.gauss(0, 3e-5)
+            lat = start_lat + (end_lat - start_lat) * fraction + rng.gauss(0, 2e-5)
+            current_speed = rng.uniform(0, 0.5) if step >= steps else max(0.0, rng.gauss(speed, 1))
+            rows.append(f"{timestamp},{lat:.7f},{lng:.7f},{current_speed:.3f},{rng.uniform(3, 10):.1f}")
+            timestamp += 1000
+        x, y = x + dx, y + dy
+    return "\n".join(rows[:target_points + 1])
+
+def match_points(points):
+    """
+    Return the grid intersections passed by the points, with the corners
+    added where consecutive intersections are not on the same street.
+    """
+    nodes = []
+    for lng, lat in points:
+        node = (round((lng - ORIGIN[0]) / GRID_STEP), round((lat - ORIGIN[1]) / GRID_STEP))
+        if nodes and node != nodes[-1] and node[0] != nodes[-1][0] and node[1] != nodes[-1][1]:
+            nodes.append((node[0], nodes[-1][1]))
+        if not nodes or nodes[-1] != node:
+            nodes.append(node)
+    return [[round(lng, 7), round(lat, 7)] for lng, lat in (grid_point(x, y) for x, y in nodes)]
+
+def create_handler(track_count, points_per_track, match_latency, match_latency_per_point, match_error_rate):
+    class FakeServicesHandler(BaseHTTPRequestHandler):
+        def log_message(self, *args):
+            pass
+
+        def send(self, data, status=200):
+            body = json.dumps(data).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            if url.path == "/tracks/list/":
+                page_size = int(query.get("pageSize", ["100"])[0])
+                page = int(query.get("page", ["1"])[0])
+                first_pk = (page - 1) * page_size + 1
+                pks = range(first_pk, min(first_pk + page_size, track_count + 1))
+                self.send({
+                    "results": [{"pk": pk, "sessionId": f"session-{pk}", "userId": f"user-{pk % 97}"} for pk in pks],
+                    "totalPages": max(1, math.ceil(track_count / page_size)),
+                })
+            elif url.path == "/tracks/fetch/":
+                pk = int(query["pk"][0])
+                metadata = {"bikeType": BIKE_TYPES[pk % len(BIKE_TYPES)]} if pk % 5 else {}
+                self.send({"gpsCSV": track_csv(pk, points_per_track), "metadata": metadata})
+            else:
+                self.send({"message": "not found"}, 404)
+
+        def do_POST(self):
+            body = self.rfile.read(int(self.headers["Content-Length"])).decode()
+            points = [(float(lng), float(lat)) for lat, lng in re.findall(r'lat="([^"]+)" lon="([^"]+)"', body)]
+            time.sleep(match_latency + match_latency_per_point * len(points))
+            # Failures depend on the request only, so repeated runs fail on the same tracks
+            if len(points) < 2 or zlib.crc32(body.encode()) / 2 ** 32 < match_error_rate:
+                return self.send({"message": "Sequence is broken for submitted track"}, 400)
+            self.send({"paths": [{"points": {"type": "LineString", "coordinates": match_points(points)}}]})
+
+    return FakeServicesHandler
+
+def serve(port, track_count=1000, points_per_track=300, match_latency=0.02, match_latency_per_point=0.00002, match_error_rate=0.01):
+    handler = create_handler(track_count, points_per_track, match_latency, match_latency_per_point, match_error_rate)
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+@contextmanager
+def running_fake_services(**options):
+    """
+    Run the fake services in a separate process, so they do not compete
+    with the benchmarked code for the GIL. Yields their base URL.
+    """
+    port = free_port()
+    process = multiprocessing.Process(target=serve, args=(port,), kwargs=options, daemon=True)
+    process.start()
+    try:
+        deadline = time.monotonic() + 10
+        while True:
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                break
+            except OSError:
+                if time.monotonic() > deadline:
+                    raise
+                time.sleep(0.05)
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        process.terminate()
+        process.join()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Fake tracking service and GraphHopper /match endpoint.")
+    parser.add_argument("--port", type=int, default=8765, help="Port to listen on. Default: 8765.")
+    parser.add_argument("--tracks", type=int, default=1000, help="Number of tracks. Default: 1000.")
+    parser.add_argument("--points-per-track", type=int, default=300, help="Mean number of GPS points per track. Default: 300.")
+    parser.add_argument("--match-latency-ms", type=float, default=20, help="Base latency of /match in ms. Default: 20.")
+    parser.add_argument("--match-latency-per-point-ms", type=float, default=0.02, help="Additional latency of /match per GPS point in ms. Default: 0.02.")
+    parser.add_argument("--match-error-rate", type=float, default=0.01, help="Share of /match requests that fail. Default: 0.01.")
+    args = parser.parse_args()
+    print(f"Serving {args.tracks} fake tracks on http://127.0.0.1:{args.port}")
+    serve(args.port, track_count=args.tracks, points_per_track=args.points_per_track, match_latency=args.match_latency_ms / 1000, match_latency_per_point=args.match_latency_per_point_ms / 1000, match_error_rate=args.match_error_rate)
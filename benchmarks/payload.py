@@ -0,0 +1,60 @@
+"""
+Compare the map matching payload builders on long tracks.
+
+Run from the repository root: python -m benchmarks.payload
+"""
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from lib.payload import format_gpx
+
+def iterrows_gpx(gps_data):
+    # The previous builder, which concatenated one string per row
+    gpx = "<gpx><trk><trkseg>"
+    for _, coordinates in gps_data.iterrows():
+        gpx += f"<trkpt lat=\"{coordinates['latitude']}\" lon=\"{coordinates['longitude']}\"></trkpt>"
+    gpx += "</trkseg></trk></gpx>"
+    return gpx
+
+def random_track(point_count, seed=0):
+    # A random walk at 1 Hz around Dresden
+    rng = np.random.default_rng(seed)
+    return pd.DataFrame({
+        "timestamp": 1700000000000 + 1000 * np.arange(point_count, dtype=np.int64),
+        "latitude": np.round(51.05 + np.cumsum(rng.normal(0, 2e-5, point_count)), 7),
+        "longitude": np.round(13.74 + np.cumsum(rng.normal(0, 3e-5, point_count)), 7),
+        "speed": rng.uniform(0, 9, point_count),
+    })
+
+def measure(build, repetitions):
+    start = time.perf_counter()
+    for _ in range(repetitions):
+        payload = build()
+    return (time.perf_counter() - start) / repetitions, len(payload)
+
+def main(point_counts, repetitions):
+    for point_count in point_counts:
+        gps_data = random_track(point_count)
+        longitudes = gps_data["longitude"].to_numpy()
+        latitudes = gps_data["latitude"].to_numpy()
+        timestamps = gps_data["timestamp"].to_numpy()
+        builders = {
+            "iterrows gpx": lambda: iterrows_gpx(gps_data),
+            "gpx": lambda: format_gpx(longitudes, latitudes),
+            "gpx with timestamps": lambda: format_gpx(longitudes, latitudes, timestamps),
+        }
+        print(f"{point_count} points:")
+        baseline_seconds = None
+        for name, build in builders.items():
+            seconds, size = measure(build, repetitions)
+            if baseline_seconds is None:
+                baseline_seconds = seconds
+            print(f"  {name:<22} {seconds * 1000:9.2f} ms  {size / 1000:8.1f} kB  {baseline_seconds / seconds:6.1f}x")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the map matching payload builders.")
+    parser.add_argument("--points", default="1000,3600,10800", help="Comma separated track lengths in points. Default: 1000,3600,10800.")
+    parser.add_argument("--repetitions", type=int, default=3, help="Repetitions per builder. Default: 3.")
+    args = parser.parse_args()
+    main([int(point_count) for point_count in args.points.split(",")], args.repetitions)
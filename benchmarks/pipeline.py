@@ -0,0 +1,132 @@
+"""
+Benchmark the pipeline stages against the local fake services, recording
+the throughput and peak memory of every scenario.
+
+The memory of a scenario is the peak allocated with tracemalloc while it
+runs, on top of what was allocated before it, including NumPy arrays but
+not the snapping worker processes. The peak RSS of the process only ever
+grows, so it is only printed for the whole run.
+
+Run from the repository root:
+
+    python -m benchmarks.pipeline --tracks 1000 --output results.json
+    python -m benchmarks.pipeline --tracks 1000 --baseline results.json
+
+With a baseline, scenarios that got slower or use more memory than the
+tolerance allows are reported and the exit code is 1.
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from benchmarks.fake_services import running_fake_services
+from lib.metrics import peak_memory_bytes
+from lib.speeds import speed_aggregate_factory
+from lib.tracks import fetch_tracks
+from process import anonymize_segments, create_geojson_output, process_segments, remove_segment_stores
+
+# Time window of the fake tracks, the fake tracking service ignores it
+START_TIME = 1672531200000
+END_TIME = 1700000000000
+
+def measure(name, run, track_count):
+    """
+    Run the scenario once while tracemalloc is tracing, returns its result
+    and measurements.
+    """
+    allocated_bytes = tracemalloc.get_traced_memory()[0]
+    tracemalloc.reset_peak()
+    start = time.perf_counter()
+    result = run()
+    seconds = time.perf_counter() - start
+    measurement = {
+        "seconds": seconds,
+        "tracks_per_second": track_count / seconds if seconds else 0.0,
+        "peak_traced_bytes": tracemalloc.get_traced_memory()[1] - allocated_bytes,
+    }
+    print(f"{name:<10} {seconds:8.2f} s {measurement['tracks_per_second']:9.1f} tracks/s  peak memory {measurement['peak_traced_bytes'] / 1024 ** 2:6.1f} MB")
+    return result, measurement
+
+def run_scenarios(url, options, directory):
+    results = {}
+    segment_store_dir = os.path.join(directory, "segments") if options.segment_store else None
+    create_speed_aggregate = speed_aggregate_factory(options.speed_aggregate)
+    tracemalloc.start()
+    
+    def fetch():
+        point_count = 0
+        for track in fetch_tracks(url, "benchmark", START_TIME, END_TIME, workers=options.fetch_workers):
+            point_count += len(track)
+        return point_count
+    _, results["fetch"] = measure("fetch", fetch, options.tracks)
+    
+    def process():
+        return process_segments(url, "benchmark", url, START_TIME, END_TIME, fetch_workers=options.fetch_workers, map_matching_workers=options.map_matching_workers, create_speed_aggregate=create_speed_aggregate, workers=options.workers, segment_store_dir=segment_store_dir, segment_store_batch_size=options.segment_store_batch_size)
+    segments, results["process"] = measure("process", process, options.tracks)
+    results["process"]["segment_count"] = len(segments)
+    
+    anonymized_segments, results["anonymize"] = measure("anonymize", lambda: anonymize_segments(segments), options.tracks)
+    results["anonymize"]["segment_count"] = len(anonymized_segments)
+    
+    path = os.path.join(directory, "output.json")
+    _, results["output"] = measure("output", lambda: create_geojson_output(anonymized_segments, START_TIME, END_TIME, path=path), options.tracks)
+    results["output"]["bytes"] = os.path.getsize(path)
+    remove_segment_stores(segments, anonymized_segments)
+    tracemalloc.stop()
+    print(f"Peak RSS of the run: {peak_memory_bytes() / 1024 ** 2:.0f} MB")
+    return results
+
+def compare(results, baseline, tolerance, min_seconds):
+    """
+    Return the regressions of the results against the baseline. Scenarios
+    slower by less than min_seconds are within the noise and not reported.
+    """
+    regressions = []
+    for scenario, measurement in results.items():
+        if scenario not in baseline:
+            continue
+        baseline_measurement = baseline[scenario]
+        if measurement["seconds"] > baseline_measurement["seconds"] * (1 + tolerance) and measurement["seconds"] - baseline_measurement["seconds"] > min_seconds:
+            regressions.append(f"{scenario}: {measurement['seconds']:.2f} s instead of {baseline_measurement['seconds']:.2f} s")
+        if "peak_traced_bytes" in baseline_measurement and measurement["peak_traced_bytes"] > baseline_measurement["peak_traced_bytes"] * (1 + tolerance):
+            regressions.append(f"{scenario}: peak memory {measurement['peak_traced_bytes'] / 1024 ** 2:.1f} MB instead of {baseline_measurement['peak_traced_bytes'] / 1024 ** 2:.1f} MB")
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the pipeline against local fake services.")
+    parser.add_argument("--tracks", type=int, default=500, help="Number of fake tracks. Default: 500.")
+    parser.add_argument("--points-per-track", type=int, default=300, help="Mean number of GPS points per track. Default: 300.")
+    parser.add_argument("--match-latency-ms", type=float, default=20, help="Base latency of the fake /match endpoint in ms. Default: 20.")
+    parser.add_argument("--fetch-workers", type=int, default=8, help="Fetch workers. Default: 8.")
+    parser.add_argument("--map-matching-workers", type=int, default=16, help="Map matching workers. Default: 16.")
+    parser.add_argument("--workers", type=int, default=1, help="Snapping worker processes. Default: 1.")
+    parser.add_argument("--speed-aggregate", choices=["histogram", "exact"], default="histogram", help="Speed aggregate. Default: histogram.")
+    parser.add_argument("--segment-store", action="store_true", help="Aggregate the segments in an on-disk SQLite store instead of in memory.")
+    parser.add_argument("--segment-store-batch-size", type=int, default=50000, help="Segments per batch of the segment store. Default: 50000.")
+    parser.add_argument("--output", help="Write the results to this JSON file.")
+    parser.add_argument("--baseline", help="Compare the results with this JSON file of a previous run.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative regression against the baseline. Default: 0.2.")
+    parser.add_argument("--min-seconds", type=float, default=0.1, help="Slowdowns below this many seconds are not regressions. Default: 0.1.")
+    options = parser.parse_args()
+    
+    with running_fake_services(track_count=options.tracks, points_per_track=options.points_per_track, match_latency=options.match_latency_ms / 1000) as url, tempfile.TemporaryDirectory() as directory:
+        results = run_scenarios(url, options, directory)
+    
+    if options.output:
+        with open(options.output, "w") as f:
+            json.dump({"options": vars(options), "results": results}, f, indent=2)
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)["results"]
+        regressions = compare(results, baseline, options.tolerance, options.min_seconds)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        if regressions:
+            sys.exit(1)
+        print("No regressions against the baseline")
+
+if __name__ == "__main__":
+    main()
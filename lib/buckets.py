@@ -0,0 +1,48 @@
+import re
+from datetime import datetime, timezone
+
+DURATION_UNITS_MS = {
+    "m": 60 * 1000,
+    "h": 60 * 60 * 1000,
+    "d": 24 * 60 * 60 * 1000,
+    "w": 7 * 24 * 60 * 60 * 1000,
+}
+
+def parse_time(value):
+    """
+    Parse a timestamp in milliseconds or an ISO 8601 date (UTC if no
+    timezone is given) into milliseconds since the epoch.
+    """
+    if value.isdigit():
+        return int(value)
+    # Python 3.10 only parses the Z suffix for UTC as offset
+    if value.endswith(("Z", "z")):
+        value = f"{value[:-1]}+00:00"
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return round(parsed.timestamp() * 1000)
+
+def parse_duration(value):
+    """
+    Parse a duration like "30m", "12h", "1d" or "1w" into milliseconds.
+    """
+    match = re.fullmatch(r"(\d+)([mhdw])", value)
+    if not match:
+        raise ValueError(f"Invalid duration: {value}, expected a number followed by m, h, d or w")
+    return int(match.group(1)) * DURATION_UNITS_MS[match.group(2)]
+
+def split_into_buckets(start_time, end_time, bucket_size):
+    """
+    Split the time range into consecutive (start_time, end_time) buckets of
+    bucket_size milliseconds. The last bucket ends at end_time.
+    """
+    if bucket_size <= 0:
+        raise ValueError("The bucket size must be positive")
+    buckets = []
+    bucket_start = start_time
+    while bucket_start < end_time:
+        bucket_end = min(bucket_start + bucket_size, end_time)
+        buckets.append((bucket_start, bucket_end))
+        bucket_start = bucket_end
+    return buckets
@@ -0,0 +1,86 @@
+import gzip
+import hashlib
+import json
+import os
+import threading
+from collections import OrderedDict
+
+class MapMatchingCache:
+    """
+    Persistent cache for map matching responses, keyed by a hash of the
+    GraphHopper URL (including the profile) and the request payload.
+    The least recently used entries are evicted once the cache grows
+    beyond max_size_bytes.
+    """
+    def __init__(self, directory, max_size_bytes):
+        self.directory = directory
+        self.max_size_bytes = max_size_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        
+        # Restore the LRU order from the modification times, which are updated on every hit
+        entries = []
+        for prefix in os.scandir(directory):
+            if not prefix.is_dir():
+                continue
+            for entry in os.scandir(prefix.path):
+                if entry.name.endswith(".json.gz"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, entry.name[:-len(".json.gz")], stat.st_size))
+        entries.sort()
+        self.entries = OrderedDict((key, size) for _, key, size in entries)
+        self.size_bytes = sum(self.entries.values())
+        
+    def key(self, url, payload):
+        return hashlib.sha256(f"{url}\n{payload}".encode()).hexdigest()
+    
+    def __path(self, key):
+        return os.path.join(self.directory, key[:2], f"{key}.json.gz")
+        
+    def get(self, key):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+        path = self.__path(key)
+        try:
+            with gzip.open(path, "rt") as f:
+                response_data = json.load(f)
+            os.utime(path)
+        except (OSError, ValueError):
+            with self.lock:
+                self.hits -= 1
+                self.misses += 1
+            return None
+        return response_data
+    
+    def put(self, key, response_data):
+        path = self.__path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with gzip.open(tmp_path, "wt") as f:
+            json.dump(response_data, f)
+        os.replace(tmp_path, path)
+        size = os.path.getsize(path)
+        with self.lock:
+            self.size_bytes += size - self.entries.pop(key, 0)
+            self.entries[key] = size
+            while self.size_bytes > self.max_size_bytes and len(self.entries) > 1:
+                evicted_key, evicted_size = self.entries.popitem(last=False)
+                self.size_bytes -= evicted_size
+                self.evictions += 1
+                try:
+                    os.remove(self.__path(evicted_key))
+                except FileNotFoundError:
+                    pass
+                
+    def print_stats(self):
+        lookups = self.hits + self.misses
+        hit_rate = self.hits / lookups * 100 if lookups else 0
+        print(f"Map matching cache: {self.hits} hits, {self.misses} misses ({hit_rate:.1f}% hit rate)")
+        print(f"Map matching cache: {len(self.entries)} entries, {self.size_bytes / 1024 / 1024:.1f} MB, {self.evictions} evictions")
@@ -0,0 +1,92 @@
+import os
+import pickle
+import time
+from lib.store import SqliteSegmentStore
+
+class Checkpointer:
+    """
+    Periodically write the partial output of a run together with the
+    pks of the tracks that are already contained in it, so that an
+    interrupted run can be resumed without counting tracks twice.
+    
+    The checkpoint is written to a temporary file first and then renamed,
+    so an interruption while writing never leaves a broken checkpoint.
+    Without a directory, nothing is written.
+    
+    If the output upserts its segments into a SqliteSegmentStore, the
+    checkpoint is saved in the store, in one transaction with the pending
+    upserts, and the checkpoint file only points to the store. Otherwise
+    the store could be ahead of the checkpoint after a crash, and the
+    tracks in between would be counted twice on resume.
+    """
+    def __init__(self, directory=None, interval_seconds=300):
+        self.active = directory is not None
+        self.path = os.path.join(directory, "checkpoint.pkl") if self.active else None
+        self.interval_seconds = interval_seconds
+        self.start_time = None
+        self.end_time = None
+        self.output = None
+        self.completed_pks = set()
+        self.last_save = time.monotonic()
+        
+    def load(self):
+        """
+        Load the last checkpoint, returns False if there is none.
+        """
+        if not self.active or not os.path.exists(self.path):
+            return False
+        with open(self.path, "rb") as f:
+            state = pickle.load(f)
+        if "segment_store" in state:
+            store_state = SqliteSegmentStore.load_checkpoint(state["segment_store"])
+            if store_state is None:
+                return False
+            state = pickle.loads(store_state)
+        self.start_time = state["start_time"]
+        self.end_time = state["end_time"]
+        self.output = state["output"]
+        self.completed_pks = state["completed_pks"]
+        return True
+    
+    def start(self, start_time, end_time, output):
+        self.start_time = start_time
+        self.end_time = end_time
+        self.output = output
+        self.completed_pks = set()
+        self.last_save = time.monotonic()
+        
+    def complete(self, pk):
+        """
+        Mark a track as completed, its result must already be in the output.
+        """
+        self.completed_pks.add(pk)
+        
+    def save_if_due(self):
+        if self.active and time.monotonic() - self.last_save >= self.interval_seconds:
+            self.save()
+            
+    def save(self):
+        if not self.active:
+            return
+        state = {
+            "start_time": self.start_time,
+            "end_time": self.end_time,
+            "output": self.output,
+            "completed_pks": self.completed_pks,
+        }
+        if self.output.store is not None:
+            self.output.store.save_checkpoint(pickle.dumps(state))
+            state = {"segment_store": self.output.store.path}
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.path)
+        self.last_save = time.monotonic()
+        print(f"Saved checkpoint with {len(self.completed_pks)} completed tracks")
+        
+    def clear(self):
+        if self.active and os.path.exists(self.path):
+            os.remove(self.path)
@@ -1,79 +1,151 @@
 import json
+import os
+import queue
+import threading
 
-class DataExchangeDebugger:
-    def __init__(self, active=False):
-        self.active = active
-            
-    def new_geojson(self):
-        if self.active:
-            self.geojson ={
-                "type": "FeatureCollection",
-                "features": [
-                    {
-                        "type": "Feature",
-                        "properties": {
-                            "type": "track",   
-                        },
-                        "geometry": {
-                            "type": "LineString",
-                            "coordinates": [],
-                        },
-                    },
-                    {
-                        "type": "Feature",
-                        "properties": {
-                            "type": "map_matched_track",   
-                        },
-                        "geometry": {
-                            "type": "LineString",
-                            "coordinates": [],
-                        },
-                    },
-                    {
-                        "type": "Feature",
-                        "properties": {
-                            "type": "snap_lines",   
-                        },
-                        "geometry": {
-                            "type": "MultiLineString",
-                            "coordinates": [],
-                        },
-                    },
-                ],
-            }
-            
-    def add_track_point(self, lng, lat):
-        if not self.active:
-            return
-        if not self.geojson:
-            raise ValueError("No geojson object created.")
-        self.geojson["features"][0]["geometry"]["coordinates"].append([lng, lat])
-        
-    def add_map_matched_point(self, lng, lat):
-        if not self.active:
-            return
-        if not self.geojson:
-            raise ValueError("No geojson object created.")
-        self.geojson["features"][1]["geometry"]["coordinates"].append([lng, lat])
+class TrackDebugger:
+    """
+    Collects the debug features of a single sampled track.
+    """
+    def __init__(self, track_idx, pk):
+        self.properties = {"track_idx": track_idx, "pk": pk}
+        self.track_coordinates = []
+        self.map_matched_coordinates = []
+        self.snapping_lines = []
+
+    def add_track_points(self, longitudes, latitudes):
+        self.track_coordinates.extend(zip(longitudes, latitudes))
+
+    def add_map_matched_points(self, points):
+        self.map_matched_coordinates.extend(points)
 
     def add_snapping_line(self, segment, gps_lng, gps_lat):
-        if not self.active:
-            return
-        if not self.geojson:
-            raise ValueError("No geojson object created.")
         segment_center = (
             (segment[0][0] + segment[1][0]) / 2,
             (segment[0][1] + segment[1][1]) / 2,
         )
-        self.geojson["features"][2]["geometry"]["coordinates"].append([
+        self.snapping_lines.append([
             [gps_lng, gps_lat],
             [segment_center[0], segment_center[1]],
         ])
-        
-    def write_geojson(self, track_idx):
+
+    def features(self):
+        return [
+            {
+                "type": "Feature",
+                "properties": {"type": "track", **self.properties},
+                "geometry": {
+                    "type": "LineString",
+                    "coordinates": [list(point) for point in self.track_coordinates],
+                },
+            },
+            {
+                "type": "Feature",
+                "properties": {"type": "map_matched_track", **self.properties},
+                "geometry": {
+                    "type": "LineString",
+                    "coordinates": [list(point) for point in self.map_matched_coordinates],
+                },
+            },
+            {
+                "type": "Feature",
+                "properties": {"type": "snap_lines", **self.properties},
+                "geometry": {
+                    "type": "MultiLineString",
+                    "coordinates": self.snapping_lines,
+                },
+            },
+        ]
+
+class DataExchangeDebugger:
+    """
+    Writes GeoJSON files with the GPS points, the map matched points and the
+    snapping lines of the sampled tracks: every sample_every-th track, or
+    only the tracks in sample_pks if given. The tracks are batched into
+    files of batch_size tracks, which are serialized and written on a
+    background thread.
+
+    start_track returns None for tracks that are not sampled and always if
+    the debugger is inactive, so callers skip the debug calls entirely.
+    """
+    def __init__(self, active=False, sample_every=1, sample_pks=None, batch_size=100, directory="debug", max_pending_batches=4):
+        self.active = active
+        self.sample_every = sample_every
+        self.sample_pks = frozenset(sample_pks) if sample_pks else None
+        self.batch_size = batch_size
+        self.directory = directory
+        self.batch = []
+        self.written_track_count = 0
+        self.written_file_count = 0
+        self.queue = None
+        self.writer = None
+        self.error = None
+        if self.active:
+            os.makedirs(directory, exist_ok=True)
+            self.queue = queue.Queue(maxsize=max_pending_batches)
+            self.writer = threading.Thread(target=self.__write_batches, daemon=True)
+            self.writer.start()
+
+    def start_track(self, track_idx, pk):
+        if not self.active:
+            return None
+        if self.sample_pks is not None:
+            if pk not in self.sample_pks:
+                return None
+        elif track_idx % self.sample_every != 0:
+            return None
+        return TrackDebugger(track_idx, pk)
+
+    def finish_track(self, track_debugger):
+        if track_debugger is None:
+            return
+        self.batch.append(track_debugger)
+        if len(self.batch) >= self.batch_size:
+            self.__flush()
+
+    def __flush(self):
+        if self.batch:
+            self.queue.put(self.batch)
+            self.batch = []
+
+    def __write_batches(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                return
+            if self.error is not None:
+                # Keep consuming the batches, so the processing is not blocked
+                continue
+            try:
+                self.__write_batch(batch)
+            except Exception as error:
+                self.error = error
+
+    def __write_batch(self, batch):
+        first_idx = batch[0].properties["track_idx"]
+        last_idx = batch[-1].properties["track_idx"]
+        if len(batch) == 1:
+            path = f"{self.directory}/track_{first_idx}.geojson"
+        else:
+            path = f"{self.directory}/tracks_{first_idx}_{last_idx}.geojson"
+        geojson = {
+            "type": "FeatureCollection",
+            "features": [feature for track_debugger in batch for feature in track_debugger.features()],
+        }
+        with open(path, "w") as f:
+            json.dump(geojson, f)
+        self.written_track_count += len(batch)
+        self.written_file_count += 1
+
+    def close(self):
+        """
+        Write the remaining tracks and wait until all files are written.
+        """
         if not self.active:
             return
-        if not self.geojson:
-            raise ValueError("No geojson object created.")
-        with open(f"debug/track_{track_idx}.geojson", "w") as f:
-                json.dump(self.geojson, f)
\ No newline at end of file
+        self.__flush()
+        self.queue.put(None)
+        self.writer.join()
+        if self.error is not None:
+            raise self.error
+        print(f"Wrote {self.written_track_count} debug tracks to {self.written_file_count} files in {self.directory}/")
@@ -1,4 +1,5 @@
 import math
+import numpy as np
 
 def snap(pos_lng, pos_lat, p1_lng, p1_lat, p2_lng, p2_lat):
     """
@@ -51,4 +52,120 @@ def haversine_distance(lng1, lat1, lng2, lat2):
     a = math.sin(dlat/2)**2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlng/2)**2
     c = 2 * math.asin(math.sqrt(a))
     r = 6371000 
-    return c * r
\ No newline at end of file
+    return c * r
+
+def snap_many(pos_lng, pos_lat, p1_lng, p1_lat, p2_lng, p2_lat):
+    """
+    Vectorized version of snap(). The reference points and the lines
+    can be given as arrays that are broadcast against each other.
+    """
+    x = pos_lat
+    y = pos_lng
+    x1 = p1_lat
+    y1 = p1_lng
+    x2 = p2_lat
+    y2 = p2_lng
+
+    A = x - x1
+    B = y - y1
+    C = x2 - x1
+    D = y2 - y1
+
+    dot = A * C + B * D
+    lenSq = C * C + D * D
+    dot, lenSq = np.broadcast_arrays(dot, lenSq)
+    param = np.divide(dot, lenSq, out=np.full(dot.shape, -1.0), where=lenSq != 0)
+
+    xx = np.where(param < 0, x1, np.where(param > 1, x2, x1 + param * C))
+    yy = np.where(param < 0, y1, np.where(param > 1, y2, y1 + param * D))
+    return yy, xx
+
+def haversine_distance_many(lng1, lat1, lng2, lat2):
+    """
+    Vectorized version of haversine_distance().
+    """
+    lng1, lat1, lng2, lat2 = map(np.radians, [lng1, lat1, lng2, lat2])
+
+    dlng = lng2 - lng1
+    dlat = lat2 - lat1
+    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlng/2)**2
+    c = 2 * np.arcsin(np.sqrt(a))
+    r = 6371000 
+    return c * r
+
+def snap_track(points, longitudes, latitudes, speeds, block_size=16):
+    """
+    Assign the GPS points of a track to the segments of its map matched path.
+    
+    The points are assigned greedily in order: every segment takes the next
+    unassigned GPS point, followed by all points that are nearer to it than
+    to the following segment. The first and the last segment are skipped
+    for anonymization.
+    
+    The distances are computed in bulk, for blocks of segments against
+    a window of the following GPS points. If the window turns out to be
+    too small, the block is computed again with a larger window.
+    
+    Returns a list of (segment, speeds, gps point indices) for every visited
+    segment. Segments that are reached after all GPS points are assigned
+    have no speeds.
+    """
+    if len(points) < 4:
+        return []
+    
+    gps_point_count = len(longitudes)
+    # Points after this index are never compared, they are assigned to the current segment
+    comparison_limit = gps_point_count - 2
+    path = np.asarray(points, dtype=float)[:, :2]
+    last_segment_idx = len(points) - 3
+    window_size = 16 + 2 * block_size * gps_point_count // len(points)
+    
+    snapped_segments = []
+    segment_idx = 1
+    gps_point_idx = 0
+    while segment_idx <= last_segment_idx:
+        block = range(segment_idx, min(segment_idx + block_size, last_segment_idx + 1))
+        window = slice(gps_point_idx, max(gps_point_idx, min(comparison_limit, gps_point_idx + window_size)))
+        
+        # Distances of the window points (columns) to the block segments and the segment after the block (rows)
+        starts = path[block.start:block.stop + 1, np.newaxis]
+        ends = path[block.start + 1:block.stop + 2, np.newaxis]
+        lngs = longitudes[np.newaxis, window]
+        lats = latitudes[np.newaxis, window]
+        snapped_lngs, snapped_lats = snap_many(lngs, lats, starts[..., 0], starts[..., 1], ends[..., 0], ends[..., 1])
+        distances = haversine_distance_many(lngs, lats, snapped_lngs, snapped_lats)
+        
+        # For every block segment and window point, the first window point from there
+        # on that is not nearer to the segment than to the next one (or the window size)
+        window_columns = np.arange(window.stop - window.start)
+        off_segment_columns = np.where(distances[:-1] < distances[1:], len(window_columns), window_columns)
+        next_off_segment_columns = np.minimum.accumulate(off_segment_columns[:, ::-1], axis=1)[:, ::-1].tolist()
+        
+        for row, segment_idx in enumerate(block):
+            segment = (
+                (points[segment_idx][0], points[segment_idx][1]),
+                (points[segment_idx + 1][0], points[segment_idx + 1][1]),
+            )
+            if gps_point_idx >= gps_point_count:
+                snapped_segments.append((segment, [], range(gps_point_idx, gps_point_idx)))
+                continue
+            
+            first_gps_point_idx = gps_point_idx
+            gps_point_idx += 1
+            if gps_point_idx < comparison_limit:
+                column = gps_point_idx - window.start
+                if column < len(window_columns) and next_off_segment_columns[row][column] < len(window_columns):
+                    gps_point_idx = window.start + next_off_segment_columns[row][column]
+                elif window.stop < comparison_limit:
+                    # Every remaining point of the window is on the segment, we need a larger window
+                    gps_point_idx = first_gps_point_idx
+                    window_size *= 2
+                    break
+                else:
+                    gps_point_idx = comparison_limit
+            
+            snapped_segments.append((segment, speeds[first_gps_point_idx:gps_point_idx].tolist(), range(first_gps_point_idx, gps_point_idx)))
+        else:
+            segment_idx = block.stop
+        
+    return snapped_segments
@@ -0,0 +1,170 @@
+import os
+import pickle
+from lib.buckets import DURATION_UNITS_MS
+from lib.store import SqliteSegmentStore
+
+# Length of the rolling layers in milliseconds, None for all buckets
+LAYER_LENGTHS = {
+    "daily": DURATION_UNITS_MS["d"],
+    "weekly": 7 * DURATION_UNITS_MS["d"],
+    "monthly": 30 * DURATION_UNITS_MS["d"],
+    "all_time": None,
+}
+
+def write_pickle(path, value):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        pickle.dump(value, f)
+    os.replace(tmp_path, path)
+    
+def read_pickle(path):
+    with open(path, "rb") as f:
+        return pickle.load(f)
+    
+def missing_milliseconds(buckets, start_time, end_time):
+    """
+    Return the milliseconds between start_time and end_time that are not
+    covered by any of the sorted buckets.
+    """
+    missing = 0
+    covered_until = start_time
+    for bucket_start_time, bucket_end_time in buckets:
+        if bucket_start_time > covered_until:
+            missing += bucket_start_time - covered_until
+        covered_until = max(covered_until, bucket_end_time)
+    return missing + max(0, end_time - covered_until)
+
+def merge_segments(segments, other_segments):
+    """
+    Merge other_segments into segments, either of them a SegmentTable or a
+    SqliteSegmentStore. A store is merged table by table.
+    """
+    if isinstance(segments, SqliteSegmentStore):
+        other_tables = other_segments.tables() if isinstance(other_segments, SqliteSegmentStore) else [other_segments]
+        for table in other_tables:
+            segments.upsert(table)
+    else:
+        segments.merge(other_segments.load() if isinstance(other_segments, SqliteSegmentStore) else other_segments)
+
+class AggregateStore:
+    """
+    Private store of the segment aggregates of every processed bucket,
+    before anonymization, and of the layers that are rolled up from them.
+    
+    A layer contains all buckets that end within its length before the end
+    of the latest bucket. New buckets are merged into the stored layer
+    aggregates. Only if a bucket falls out of a rolling layer, the layer is
+    merged again from the stored bucket aggregates. Tracks are never
+    processed again.
+    
+    Buckets that were aggregated in a SqliteSegmentStore are kept as a copy
+    of the store, and a layer that is rolled up from such a bucket is an
+    SQLite store as well, so it is merged without loading it into memory.
+    Its pickle only points to the store, and the buckets of a layer store
+    are committed with its segments as checkpoint of the store.
+    """
+    def __init__(self, directory, create_speed_aggregate=None, batch_size=50000):
+        self.directory = directory
+        self.create_speed_aggregate = create_speed_aggregate
+        self.batch_size = batch_size
+        
+    def __bucket_path(self, start_time, end_time):
+        return os.path.join(self.directory, "buckets", f"{start_time}_{end_time}.pkl")
+    
+    def __layer_path(self, name):
+        return os.path.join(self.directory, "layers", f"{name}.pkl")
+    
+    def __open_store(self, path):
+        return SqliteSegmentStore(path, self.create_speed_aggregate, batch_size=self.batch_size)
+        
+    def save_bucket(self, segments, start_time, end_time):
+        if isinstance(segments, SqliteSegmentStore):
+            store_path = f"{os.path.splitext(self.__bucket_path(start_time, end_time))[0]}.sqlite"
+            segments.copy(store_path)
+            segments = {"segment_store": os.path.basename(store_path)}
+        write_pickle(self.__bucket_path(start_time, end_time), segments)
+        
+    def load_bucket(self, start_time, end_time):
+        segments = read_pickle(self.__bucket_path(start_time, end_time))
+        if isinstance(segments, dict):
+            return self.__open_store(os.path.join(self.directory, "buckets", segments["segment_store"]))
+        return segments
+    
+    def __load_layer(self, name):
+        # Returns the buckets and the segments of the stored layer, or None, None
+        layer_path = self.__layer_path(name)
+        if not os.path.exists(layer_path):
+            return None, None
+        layer = read_pickle(layer_path)
+        if "segment_store" not in layer:
+            return layer["buckets"], layer["segments"]
+        store_path = os.path.join(self.directory, "layers", layer["segment_store"])
+        state = SqliteSegmentStore.load_checkpoint(store_path)
+        if state is None:
+            return None, None
+        return pickle.loads(state), self.__open_store(store_path)
+    
+    def __save_layer(self, name, buckets, segments):
+        if isinstance(segments, SqliteSegmentStore):
+            segments.save_checkpoint(pickle.dumps(buckets))
+            layer = {"segment_store": os.path.basename(segments.path)}
+        else:
+            layer = {"buckets": buckets, "segments": segments}
+        write_pickle(self.__layer_path(name), layer)
+    
+    def buckets(self):
+        bucket_dir = os.path.join(self.directory, "buckets")
+        if not os.path.isdir(bucket_dir):
+            return []
+        buckets = []
+        for file_name in os.listdir(bucket_dir):
+            if file_name.endswith(".pkl"):
+                start_time, end_time = file_name[:-len(".pkl")].split("_")
+                buckets.append((int(start_time), int(end_time)))
+        return sorted(buckets)
+    
+    def update_layers(self):
+        """
+        Roll the stored buckets up into the layers. Returns a dict of
+        layer name to (segments, start_time, end_time).
+        """
+        buckets = self.buckets()
+        if not buckets:
+            return {}
+        end_time = max(bucket_end_time for _, bucket_end_time in buckets)
+        
+        layers = {}
+        for name, length in LAYER_LENGTHS.items():
+            window_buckets = [bucket for bucket in buckets if length is None or bucket[1] > end_time - length]
+            # E.g. if the directory was wiped between runs, the layer silently contains fewer tracks
+            missing = missing_milliseconds(window_buckets, window_buckets[0][0] if length is None else end_time - length, end_time)
+            if missing > 0:
+                print(f"Warning: layer {name} is missing buckets for {missing / DURATION_UNITS_MS['h']:.1f} h of its window, is {self.directory} kept between runs?")
+            
+            layer_buckets, segments = self.__load_layer(name)
+            if layer_buckets is None or not set(layer_buckets).issubset(window_buckets):
+                if isinstance(segments, SqliteSegmentStore):
+                    segments.close()
+                segments = None
+                new_buckets = window_buckets
+            else:
+                new_buckets = [bucket for bucket in window_buckets if bucket not in layer_buckets]
+            
+            for bucket in new_buckets:
+                bucket_segments = self.load_bucket(*bucket)
+                if segments is None and isinstance(bucket_segments, SqliteSegmentStore):
+                    # The bucket store is kept as it is, the layer gets its own store
+                    segments = SqliteSegmentStore.create(os.path.join(self.directory, "layers", f"{name}.sqlite"), self.create_speed_aggregate, batch_size=self.batch_size)
+                if segments is None:
+                    segments = bucket_segments
+                else:
+                    merge_segments(segments, bucket_segments)
+                if isinstance(bucket_segments, SqliteSegmentStore):
+                    bucket_segments.close()
+            
+            if new_buckets:
+                self.__save_layer(name, window_buckets, segments)
+            print(f"Layer {name}: {len(window_buckets)} buckets, {len(new_buckets)} merged")
+            layers[name] = (segments, window_buckets[0][0], end_time)
+        return layers
@@ -0,0 +1,155 @@
+import threading
+import time
+import requests
+from lib.metrics import metrics
+from lib.payload import GPX_CONTENT_TYPE
+from lib.session import create_session
+
+class AdaptiveConcurrencyLimit:
+    """
+    Limit the number of concurrent requests with an additive increase,
+    multiplicative decrease (AIMD) strategy: the limit grows by one per
+    window of fast responses and is halved on timeouts or server errors.
+    A response counts as fast if the smoothed latency stays within
+    latency_tolerance times the lowest latency seen so far.
+    """
+    def __init__(self, initial=2, minimum=1, maximum=16, latency_tolerance=2.0):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.latency_tolerance = latency_tolerance
+        self.in_flight = 0
+        self.max_limit_reached = initial
+        self.min_latency = None
+        self.smoothed_latency = None
+        self.condition = threading.Condition()
+        
+    def acquire(self):
+        with self.condition:
+            while self.in_flight >= int(self.limit):
+                self.condition.wait()
+            self.in_flight += 1
+            
+    def release(self, latency=None):
+        """
+        Release a slot, with the latency of the successful request,
+        or None if the request failed.
+        """
+        with self.condition:
+            self.in_flight -= 1
+            if latency is None:
+                self.limit = max(self.minimum, self.limit / 2)
+            else:
+                if self.min_latency is None or latency < self.min_latency:
+                    self.min_latency = latency
+                if self.smoothed_latency is None:
+                    self.smoothed_latency = latency
+                else:
+                    self.smoothed_latency = 0.8 * self.smoothed_latency + 0.2 * latency
+                if self.smoothed_latency <= self.latency_tolerance * self.min_latency:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                    self.max_limit_reached = max(self.max_limit_reached, int(self.limit))
+            self.condition.notify_all()
+
+class MapMatcher:
+    """
+    Send map matching requests to GraphHopper over a pooled session,
+    keeping as many requests in flight as the adaptive limit allows.
+    Failed requests, server errors and throttled requests (429) are retried
+    with a backoff. If a cache is given, responses are looked up there first
+    and stored after matching.
+    """
+    def __init__(self, graphhopper_service_url, profile="bike2_default", max_concurrency=16, timeout=60, retries=3, backoff_factor=0.5, cache=None):
+        self.url = f"{graphhopper_service_url}/match?profile={profile}&points_encoded=false&instructions=false"
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.cache = cache
+        self.session = create_session(pool_size=max_concurrency, retries=0)
+        self.limit = AdaptiveConcurrencyLimit(maximum=max_concurrency)
+        self.lock = threading.Lock()
+        self.request_count = 0
+        self.failed_request_count = 0
+        self.total_latency = 0.0
+        
+    def match(self, gpx):
+        """
+        Match the track in the GPX document and return the parsed
+        GraphHopper response.
+        If all attempts fail, the last error response (or an empty response)
+        is returned, which is then counted as a map matching error, like a
+        client error response or a response that is not JSON.
+        Only successful responses and rejected tracks (400) are cached,
+        other errors like 401, 403 or 408 may succeed on a later run.
+        """
+        if self.cache is not None:
+            cache_key = self.cache.key(self.url, gpx)
+            response_data = self.cache.get(cache_key)
+            if response_data is not None:
+                metrics.increment("map_matching_cache_hits")
+                return response_data
+            metrics.increment("map_matching_cache_misses")
+        
+        response_data = {}
+        for attempt in range(self.retries + 1):
+            if attempt > 0:
+                time.sleep(self.backoff_factor * (2 ** (attempt - 1)))
+            self.limit.acquire()
+            start = time.perf_counter()
+            try:
+                response = self.session.post(
+                    self.url,
+                    data=gpx,
+                    headers={'Content-Type': GPX_CONTENT_TYPE},
+                    timeout=self.timeout,
+                )
+            except requests.RequestException:
+                # Timeouts, connection errors and e.g. truncated responses of a proxy
+                self.limit.release(None)
+                self.__count(None)
+                continue
+            latency = time.perf_counter() - start
+            # Overloaded or throttled, the limit backs off before the retry
+            if response.status_code >= 500 or response.status_code == 429:
+                self.limit.release(None)
+                self.__count(None)
+                try:
+                    response_data = response.json()
+                except ValueError:
+                    response_data = {}
+                continue
+            self.limit.release(latency)
+            self.__count(latency)
+            try:
+                response_data = response.json()
+            except ValueError:
+                # E.g. an HTML error page of a proxy
+                response_data = {"message": f"Invalid map matching response with status {response.status_code}"}
+            if self.cache is not None and (200 <= response.status_code < 300 or response.status_code == 400):
+                self.cache.put(cache_key, response_data)
+            return response_data
+        return response_data
+    
+    def __count(self, latency):
+        if latency is None:
+            metrics.increment("graphhopper_match_failures")
+        else:
+            metrics.observe("graphhopper_match", latency)
+        with self.lock:
+            self.request_count += 1
+            if latency is None:
+                self.failed_request_count += 1
+            else:
+                self.total_latency += latency
+                
+    def close(self):
+        self.session.close()
+    
+    def print_stats(self):
+        successful_request_count = self.request_count - self.failed_request_count
+        mean_latency = self.total_latency / successful_request_count if successful_request_count else 0
+        print(f"Sent {self.request_count} map matching requests ({self.failed_request_count} failed)")
+        print(f"Mean map matching latency: {mean_latency * 1000:.0f} ms")
+        print(f"Map matching concurrency: {int(self.limit.limit)} (max. {self.limit.max_limit_reached})")
+        if self.cache is not None:
+            self.cache.print_stats()
@@ -0,0 +1,177 @@
+import json
+import math
+import os
+import resource
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+class LatencyHistogram:
+    """
+    Histogram of latencies in seconds with fixed buckets, like the ones of
+    a Prometheus histogram. Percentiles are the upper bound of the bucket
+    that contains them.
+    """
+    BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, math.inf)
+    __slots__ = ("counts", "count", "sum", "max")
+
+    def __init__(self):
+        self.counts = [0] * len(self.BOUNDS)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        for index, bound in enumerate(self.BOUNDS):
+            if seconds <= bound:
+                self.counts[index] += 1
+                break
+        self.count += 1
+        self.sum += seconds
+        self.max = max(self.max, seconds)
+
+    def percentile(self, q):
+        if self.count == 0:
+            return 0.0
+        rank = q / 100 * self.count
+        cumulative = 0
+        for bound, count in zip(self.BOUNDS, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return min(bound, self.max)
+        return self.max
+
+    def to_json(self):
+        return {
+            "count": self.count,
+            "sum_seconds": self.sum,
+            "mean_seconds": self.sum / self.count if self.count else 0.0,
+            "p50_seconds": self.percentile(50),
+            "p90_seconds": self.percentile(90),
+            "p99_seconds": self.percentile(99),
+            "max_seconds": self.max,
+            "buckets": {str(bound): count for bound, count in zip(self.BOUNDS, self.counts)},
+        }
+
+def peak_memory_bytes():
+    """
+    Peak resident memory of this process and of the largest finished child
+    process (the snapping workers), ru_maxrss is in kB on Linux.
+    """
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return max(own, children) * 1024
+
+class Metrics:
+    """
+    Thread safe counters and latency histograms of a run. Stages of the
+    pipeline are timed with the time context manager or observe, the
+    results are written as JSON run report or as Prometheus textfile.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.start = time.perf_counter()
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, seconds):
+        with self.lock:
+            if name not in self.histograms:
+                self.histograms[name] = LatencyHistogram()
+            self.histograms[name].observe(seconds)
+
+    @contextmanager
+    def time(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def timed(self, name):
+        """
+        Decorator that times every call of the function.
+        """
+        def decorator(function):
+            @wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.time(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def count(self, name):
+        return self.counters.get(name, 0)
+
+    def histogram(self, name):
+        return self.histograms.get(name, LatencyHistogram())
+
+    def seconds(self, name):
+        histogram = self.histograms.get(name)
+        return histogram.sum if histogram is not None else 0.0
+
+    def report(self, elapsed_seconds=None, **properties):
+        """
+        The throughput is computed over elapsed_seconds, e.g. the wall time
+        of a backfill whose buckets are processed in parallel, and otherwise
+        over the time spent in process_segments.
+        """
+        with self.lock:
+            wall_seconds = time.perf_counter() - self.start
+            processing_seconds = elapsed_seconds if elapsed_seconds is not None else self.seconds("process_segments")
+            return {
+                **properties,
+                "wall_seconds": wall_seconds,
+                "tracks_per_second": self.counters.get("tracks_processed", 0) / processing_seconds if processing_seconds else 0.0,
+                "points_per_second": self.counters.get("gps_points_processed", 0) / processing_seconds if processing_seconds else 0.0,
+                "peak_memory_bytes": peak_memory_bytes(),
+                "counters": dict(self.counters),
+                "latencies": {name: histogram.to_json() for name, histogram in self.histograms.items()},
+            }
+
+    def write_report(self, path, elapsed_seconds=None, **properties):
+        report = self.report(elapsed_seconds=elapsed_seconds, **properties)
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote run report to {path}: {report['tracks_per_second']:.1f} tracks/s, {report['points_per_second']:.0f} points/s, peak memory {report['peak_memory_bytes'] / 1024 ** 2:.0f} MB")
+
+    def write_prometheus(self, path, prefix="data_exchange", elapsed_seconds=None):
+        """
+        Write the metrics in the Prometheus text format, e.g. for the
+        textfile collector of the node exporter. The file is replaced
+        atomically, so the collector never reads a partial file.
+        """
+        report = self.report(elapsed_seconds=elapsed_seconds)
+        lines = []
+        for name in ("wall_seconds", "tracks_per_second", "points_per_second", "peak_memory_bytes"):
+            lines.append(f"# TYPE {prefix}_{name} gauge")
+            lines.append(f"{prefix}_{name} {report[name]}")
+        for name, value in sorted(report["counters"].items()):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {value}")
+        with self.lock:
+            histograms = sorted(self.histograms.items())
+            lines.append(f"# TYPE {prefix}_latency_seconds histogram")
+            for name, histogram in histograms:
+                cumulative = 0
+                for bound, count in zip(histogram.BOUNDS, histogram.counts):
+                    cumulative += count
+                    le = "+Inf" if bound == math.inf else str(bound)
+                    lines.append(f'{prefix}_latency_seconds_bucket{{stage="{name}",le="{le}"}} {cumulative}')
+                lines.append(f'{prefix}_latency_seconds_sum{{stage="{name}"}} {histogram.sum}')
+                lines.append(f'{prefix}_latency_seconds_count{{stage="{name}"}} {histogram.count}')
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        os.replace(tmp_path, path)
+
+# Metrics of the current run, shared by all stages
+metrics = Metrics()
@@ -1,69 +1,101 @@
+import numpy as np
+from lib.segments import SegmentTable
+from lib.speeds import speed_aggregate_factory
+
 class SegmentProcessingOutput:
-    def __init__(self):
+    """
+    Counts of the processed tracks and the aggregates of their segments.
+    
+    Without a store, all segments are aggregated in one SegmentTable in
+    memory. With a store, e.g. a SqliteSegmentStore, the segments are
+    aggregated in memory until the table has flush_size segments and are
+    then upserted into the store, so the memory stays bounded.
+    """
+    def __init__(self, create_speed_aggregate=None, store=None, flush_size=50000):
+        if create_speed_aggregate is None:
+            create_speed_aggregate = speed_aggregate_factory()
         self.too_short_tracks_count = 0
         self.invalid_tracks_count = 0
         self.tracks_with_map_matching_error_count = 0
         self.tracks_with_invalid_map_matching_count = 0
-        self.__all_segments = []
-        self.__processed_segments = {}
-        
-    def __get_segment_key(self, segment):
-        return f"{segment[0][0]}_{segment[0][1]}_{segment[1][0]}_{segment[1][1]}"
+        self.create_speed_aggregate = create_speed_aggregate
+        self.store = store
+        self.flush_size = flush_size
+        self.__segments = SegmentTable(create_speed_aggregate)
     
     def add_segment(self, segment):
-        self.__all_segments.append(self.__get_segment_key(segment))
+        self.__segments.add_traversal(segment)
+        self.__flush_if_full()
     
     def add_processed_segment(self, segment, bike_type, speeds):
-        segment_key = self.__get_segment_key(segment)
-        if segment_key not in self.__processed_segments:
-            self.__processed_segments[segment_key] = {
-                "total_count": 1,
-                "total_speeds": speeds,
-                "profiles": {
-                    bike_type: {
-                        "count": 1,
-                        "speeds": speeds,
-                    }
-                }
-            }
-        else:
-            self.__processed_segments[segment_key]["total_count"] += 1
-            if bike_type in self.__processed_segments[segment_key]["profiles"]:
-                self.__processed_segments[segment_key]["profiles"][bike_type]["count"] += 1
-                self.__processed_segments[segment_key]["profiles"][bike_type]["speeds"].extend(speeds)
-            else:
-                self.__processed_segments[segment_key]["profiles"][bike_type] = {
-                    "count": 1,
-                    "speeds": speeds,
-                }
+        self.__segments.add_speeds(segment, bike_type, speeds)
+        self.__flush_if_full()
+        
+    def __flush_if_full(self):
+        if self.store is not None and len(self.__segments) >= self.flush_size:
+            self.flush()
+            
+    def flush(self):
+        """
+        Upsert the segments aggregated in memory into the store.
+        """
+        if self.store is not None and len(self.__segments) > 0:
+            self.store.upsert(self.__segments)
+            self.__segments = SegmentTable(self.create_speed_aggregate)
+            
+    def commit(self):
+        """
+        Make the upserted segments durable. With checkpoints, the store is
+        committed by the Checkpointer instead, together with the checkpoint.
+        """
+        if self.store is not None:
+            self.store.commit()
+                
+    def merge(self, other):
+        """
+        Merge the counts and segments of another output into this output.
+        The other output must not be used afterwards.
+        """
+        self.too_short_tracks_count += other.too_short_tracks_count
+        self.invalid_tracks_count += other.invalid_tracks_count
+        self.tracks_with_map_matching_error_count += other.tracks_with_map_matching_error_count
+        self.tracks_with_invalid_map_matching_count += other.tracks_with_invalid_map_matching_count
+        self.__segments.merge(other.__segments)
+        self.__flush_if_full()
                 
     def get_processed_segments(self):
+        if self.store is not None:
+            self.flush()
+            self.commit()
+            mismatch = self.store.count_mismatch()
+            if mismatch is not None:
+                raise ValueError(f"Total count of segment {self.store.key(mismatch)} does not match the sum of the counts of the profiles")
+            return self.store
+        
         # Check if the total count matches the sum of the counts of the profiles
-        for segment in self.__processed_segments:
-            total_count = self.__processed_segments[segment]["total_count"]
-            profile_counts = sum([self.__processed_segments[segment]["profiles"][profile]["count"] for profile in self.__processed_segments[segment]["profiles"]])
-            if total_count != profile_counts:
-                raise ValueError(f"Total count of segment {segment} does not match the sum of the counts of the profiles")
-        return self.__processed_segments
+        mismatches = np.flatnonzero(self.__segments.total_counts != self.__segments.profile_counts.sum(axis=1))
+        if len(mismatches) > 0:
+            raise ValueError(f"Total count of segment {self.__segments.key(mismatches[0])} does not match the sum of the counts of the profiles")
+        return self.__segments
             
     def print_meta_stats(self):
-        print(f"Found a total of {len(self.__all_segments)} segments")
-        print(f"Found {len(self.__processed_segments)} unique segments")
-        
-        total_unprocessed_segments_count = 0
-        unprocessed_segments = set()
-        for segment in self.__all_segments:
-            if segment not in self.__processed_segments:
-                total_unprocessed_segments_count += 1
-                unprocessed_segments.add(segment)
-        unique_unprocessed_segments = len(unprocessed_segments)
-        
-        print(f"Found {total_unprocessed_segments_count} unprocessed segments")
-        print(f"Found {unique_unprocessed_segments} unique unprocessed segments")
+        if self.store is not None:
+            self.flush()
+            traversal_count, processed_count, unprocessed_traversal_count, unprocessed_count = self.store.meta_stats()
+        else:
+            processed = self.__segments.total_counts > 0
+            traversal_count = self.__segments.traversal_counts.sum()
+            processed_count = processed.sum()
+            # Segments that were traversed, but never got any speeds snapped to them
+            unprocessed_traversal_counts = self.__segments.traversal_counts[~processed]
+            unprocessed_traversal_count = unprocessed_traversal_counts.sum()
+            unprocessed_count = np.count_nonzero(unprocessed_traversal_counts)
+        print(f"Found a total of {traversal_count} segments")
+        print(f"Found {processed_count} unique segments")
+        print(f"Found {unprocessed_traversal_count} unprocessed segments")
+        print(f"Found {unprocessed_count} unique unprocessed segments")
         
         print(f"Found {self.too_short_tracks_count} too short tracks")
         print(f"Found {self.invalid_tracks_count} invalid tracks")
         print(f"Found {self.tracks_with_map_matching_error_count} tracks with map matching errors")
         print(f"Found {self.tracks_with_invalid_map_matching_count} tracks with invalid map matching")
-        
-    
\ No newline at end of file
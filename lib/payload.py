@@ -0,0 +1,45 @@
+import numpy as np
+
+GPX_CONTENT_TYPE = "application/gpx+xml"
+
+# 7 decimals are about 1 cm, which is more than the precision of the GPS data
+COORDINATE_PRECISION = 7
+
+def format_timestamps(timestamps):
+    """
+    Format millisecond timestamps as ISO 8601 strings, without the Z for UTC.
+    """
+    return np.datetime_as_string(np.asarray(timestamps).astype("datetime64[ms]"), unit="ms").tolist()
+
+def interleave(*columns):
+    # The values of one point are consecutive, as expected by the format strings below
+    if len(columns) == 2:
+        return tuple(np.column_stack(columns).ravel().tolist())
+    return tuple(value for point in zip(*[column.tolist() if isinstance(column, np.ndarray) else column for column in columns]) for value in point)
+
+def format_gpx(longitudes, latitudes, timestamps=None, precision=COORDINATE_PRECISION):
+    """
+    Format the track points as a GPX document. All points are formatted with
+    one format string instead of concatenating a string per point.
+    """
+    if timestamps is None:
+        point_format = f'<trkpt lat="%.{precision}f" lon="%.{precision}f"></trkpt>'
+        values = interleave(latitudes, longitudes)
+    else:
+        point_format = f'<trkpt lat="%.{precision}f" lon="%.{precision}f"><time>%sZ</time></trkpt>'
+        values = interleave(latitudes, longitudes, format_timestamps(timestamps))
+    return f"<gpx><trk><trkseg>{(point_format * len(longitudes)) % values}</trkseg></trk></gpx>"
+
+def encode_track(track, include_timestamps=False, indices=None):
+    """
+    Encode the points of a track, or only the points at the given indices,
+    as GPX map matching request body, the only format accepted by the
+    GraphHopper /match endpoint. Timestamps are only included if requested
+    and the track has them.
+    """
+    longitudes, latitudes = track.longitudes, track.latitudes
+    timestamps = track.timestamps if include_timestamps else None
+    if indices is not None:
+        longitudes, latitudes = longitudes[indices], latitudes[indices]
+        timestamps = timestamps[indices] if timestamps is not None else None
+    return format_gpx(longitudes, latitudes, timestamps)
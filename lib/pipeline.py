@@ -0,0 +1,76 @@
+import queue
+import threading
+from collections import deque
+
+class _Failure:
+    def __init__(self, exception):
+        self.exception = exception
+
+_DONE = object()
+
+def ordered_map(executor, fn, iterable, max_pending):
+    """
+    Apply fn to every item of the iterable on the executor and yield the
+    results in input order. At most max_pending items are in flight, the
+    iterable is only advanced when one of them has been yielded.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(executor.submit(fn, item))
+        if len(pending) >= max_pending:
+            yield pending.popleft().result()
+    while pending:
+        yield pending.popleft().result()
+
+def batched(iterable, size):
+    """
+    Yield lists of up to size consecutive items of the iterable.
+    """
+    batch = []
+    for item in iterable:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def prefetch(iterable, max_size):
+    """
+    Consume the iterable on a background thread and yield its items through
+    a bounded queue. The background thread blocks while the queue is full.
+    """
+    items = queue.Queue(maxsize=max_size)
+    stopped = threading.Event()
+    
+    def put(item):
+        while not stopped.is_set():
+            try:
+                items.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+    
+    def produce():
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(_Failure(e))
+            return
+        put(_DONE)
+    
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item = items.get()
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.exception
+            yield item
+    finally:
+        stopped.set()
@@ -0,0 +1,231 @@
+import numpy as np
+
+# Coordinates are quantized to 1e-7 degrees (about 1 cm), which fits into an int32
+COORDINATE_SCALE = 10 ** 7
+
+def quantize_segment(segment):
+    return (
+        round(segment[0][0] * COORDINATE_SCALE),
+        round(segment[0][1] * COORDINATE_SCALE),
+        round(segment[1][0] * COORDINATE_SCALE),
+        round(segment[1][1] * COORDINATE_SCALE),
+    )
+
+def pack_segment_key(quantized_segment):
+    """
+    Pack the four quantized coordinates of a segment into one integer.
+    """
+    key = 0
+    for value in quantized_segment:
+        key = (key << 32) | (value & 0xFFFFFFFF)
+    return key
+
+def merged_speeds(speeds, other_speeds):
+    """
+    Merge two speed aggregates of the same segment, either may be None.
+    The other aggregate is reused if there is nothing to merge it into.
+    """
+    if speeds is None:
+        return other_speeds
+    if other_speeds is not None:
+        speeds.merge(other_speeds)
+    return speeds
+
+class SegmentTable:
+    """
+    Table of unique segments. Every segment is interned by its packed
+    quantized coordinates and gets a dense id, which indexes the NumPy
+    arrays of coordinates and counts and the lists of speed aggregates.
+
+    A segment is added to the table as soon as it is traversed, it only
+    counts as processed once speeds have been snapped to it.
+    """
+    def __init__(self, create_speed_aggregate, capacity=1024):
+        self.create_speed_aggregate = create_speed_aggregate
+        self.ids = {}
+        self.size = 0
+        self.profile_names = []
+        self.profile_columns = {}
+        self.__coordinates = np.zeros((capacity, 4), dtype=np.int32)
+        self.__traversal_counts = np.zeros(capacity, dtype=np.int64)
+        self.__total_counts = np.zeros(capacity, dtype=np.int64)
+        self.__profile_counts = np.zeros((capacity, 0), dtype=np.int64)
+        self.total_speeds = []
+        self.profile_speeds = []
+
+    def __len__(self):
+        return self.size
+
+    @property
+    def coordinates(self):
+        return self.__coordinates[:self.size]
+
+    @property
+    def traversal_counts(self):
+        return self.__traversal_counts[:self.size]
+
+    @property
+    def total_counts(self):
+        return self.__total_counts[:self.size]
+
+    @property
+    def profile_counts(self):
+        return self.__profile_counts[:self.size]
+
+    @staticmethod
+    def __resized(array, capacity):
+        resized = np.zeros((capacity,) + array.shape[1:], dtype=array.dtype)
+        resized[:min(capacity, len(array))] = array[:capacity]
+        return resized
+
+    def __grow(self):
+        capacity = 2 * len(self.__coordinates)
+        self.__coordinates = self.__resized(self.__coordinates, capacity)
+        self.__traversal_counts = self.__resized(self.__traversal_counts, capacity)
+        self.__total_counts = self.__resized(self.__total_counts, capacity)
+        self.__profile_counts = self.__resized(self.__profile_counts, capacity)
+
+    def __profile_column(self, bike_type):
+        if bike_type not in self.profile_columns:
+            self.profile_columns[bike_type] = len(self.profile_names)
+            self.profile_names.append(bike_type)
+            self.__profile_counts = np.hstack([self.__profile_counts, np.zeros((len(self.__profile_counts), 1), dtype=np.int64)])
+            self.profile_speeds.append([None] * self.size)
+        return self.profile_columns[bike_type]
+
+    def intern(self, quantized_segment):
+        """
+        Return the id of the quantized segment, adding it to the table if needed.
+        """
+        key = pack_segment_key(quantized_segment)
+        segment_id = self.ids.get(key)
+        if segment_id is None:
+            if self.size == len(self.__coordinates):
+                self.__grow()
+            segment_id = self.size
+            self.ids[key] = segment_id
+            self.__coordinates[segment_id] = quantized_segment
+            self.total_speeds.append(None)
+            for speeds in self.profile_speeds:
+                speeds.append(None)
+            self.size += 1
+        return segment_id
+
+    def add_traversal(self, segment):
+        segment_id = self.intern(quantize_segment(segment))
+        self.__traversal_counts[segment_id] += 1
+
+    def add_speeds(self, segment, bike_type, speeds):
+        segment_id = self.intern(quantize_segment(segment))
+        column = self.__profile_column(bike_type)
+        self.__total_counts[segment_id] += 1
+        self.__profile_counts[segment_id, column] += 1
+        if self.total_speeds[segment_id] is None:
+            self.total_speeds[segment_id] = self.create_speed_aggregate()
+        self.total_speeds[segment_id].add(speeds)
+        if self.profile_speeds[column][segment_id] is None:
+            self.profile_speeds[column][segment_id] = self.create_speed_aggregate()
+        self.profile_speeds[column][segment_id].add(speeds)
+
+    def merge(self, other):
+        """
+        Add the segments, counts and speeds of another table to this table.
+        The speed aggregates of the other table are reused, so it must not
+        be used afterwards.
+        """
+        segment_ids = np.array([self.intern(tuple(quantized_segment)) for quantized_segment in other.coordinates.tolist()], dtype=np.int64)
+        self.__traversal_counts[segment_ids] += other.traversal_counts
+        self.__total_counts[segment_ids] += other.total_counts
+        for segment_id, other_speeds in zip(segment_ids.tolist(), other.total_speeds):
+            self.total_speeds[segment_id] = merged_speeds(self.total_speeds[segment_id], other_speeds)
+        for other_column, bike_type in enumerate(other.profile_names):
+            column = self.__profile_column(bike_type)
+            self.__profile_counts[segment_ids, column] += other.profile_counts[:, other_column]
+            profile_speeds = self.profile_speeds[column]
+            for segment_id, other_speeds in zip(segment_ids.tolist(), other.profile_speeds[other_column]):
+                profile_speeds[segment_id] = merged_speeds(profile_speeds[segment_id], other_speeds)
+
+    def processed_ids(self):
+        return np.flatnonzero(self.total_counts > 0)
+
+    def segment(self, segment_id):
+        """
+        Return the segment ((lng, lat), (lng, lat)) with the given id.
+        """
+        start_lng, start_lat, end_lng, end_lat = (self.__coordinates[segment_id] / COORDINATE_SCALE).tolist()
+        return ((start_lng, start_lat), (end_lng, end_lat))
+
+    def key(self, segment_id):
+        """
+        Return the segment key as used in the JSON dumps, "startlng_startlat_endlng_endlat".
+        """
+        return "_".join(str(value) for value in (self.__coordinates[segment_id] / COORDINATE_SCALE).tolist())
+
+    def profiles(self, segment_id):
+        """
+        Return the count and the speed aggregate of every profile on the segment.
+        """
+        return {
+            bike_type: {
+                "count": int(self.__profile_counts[segment_id, column]),
+                "speeds": self.profile_speeds[column][segment_id],
+            }
+            for column, bike_type in enumerate(self.profile_names)
+            if self.__profile_counts[segment_id, column] > 0
+        }
+
+    @classmethod
+    def from_columns(cls, create_speed_aggregate, coordinates, traversal_counts, total_counts, profile_names, profile_counts, total_speeds, profile_speeds):
+        """
+        Return a new table with the given columns, the segments get the ids
+        0 to n - 1 in the given order. profile_counts has one column and
+        profile_speeds one list per profile name.
+        """
+        size = len(coordinates)
+        table = cls(create_speed_aggregate, capacity=max(1, size))
+        table.size = size
+        table.__coordinates[:size] = coordinates
+        table.__traversal_counts[:size] = traversal_counts
+        table.__total_counts[:size] = total_counts
+        table.__profile_counts = cls.__resized(np.asarray(profile_counts, dtype=np.int64).reshape(size, len(profile_names)), len(table.__coordinates))
+        table.ids = {pack_segment_key(tuple(quantized_segment)): segment_id for segment_id, quantized_segment in enumerate(table.coordinates.tolist())}
+        table.profile_names = list(profile_names)
+        table.profile_columns = {bike_type: column for column, bike_type in enumerate(profile_names)}
+        table.total_speeds = list(total_speeds)
+        table.profile_speeds = [list(speeds) for speeds in profile_speeds]
+        return table
+
+    def subset(self, segment_ids):
+        """
+        Return a new table with the given segments. The speed aggregates
+        are shared with this table.
+        """
+        return SegmentTable.from_columns(
+            self.create_speed_aggregate,
+            self.__coordinates[segment_ids],
+            self.__traversal_counts[segment_ids],
+            self.__total_counts[segment_ids],
+            self.profile_names,
+            self.__profile_counts[segment_ids],
+            [self.total_speeds[segment_id] for segment_id in segment_ids],
+            [[speeds[segment_id] for segment_id in segment_ids] for speeds in self.profile_speeds],
+        )
+
+    def to_json(self):
+        """
+        Return the processed segments in the format of the JSON debug dumps.
+        """
+        return {
+            self.key(segment_id): {
+                "total_count": int(self.__total_counts[segment_id]),
+                "total_speeds": self.total_speeds[segment_id].to_json(),
+                "profiles": {
+                    bike_type: {
+                        "count": profile["count"],
+                        "speeds": profile["speeds"].to_json(),
+                    }
+                    for bike_type, profile in self.profiles(segment_id).items()
+                },
+            }
+            for segment_id in self.processed_ids().tolist()
+        }
@@ -0,0 +1,93 @@
+import math
+import threading
+import numpy as np
+
+EARTH_RADIUS = 6371000
+
+def project(longitudes, latitudes):
+    """
+    Project the points onto a local plane in meters (equirectangular around
+    the mean latitude), which is exact enough for the extent of a track.
+    """
+    scale = EARTH_RADIUS * math.pi / 180
+    x = longitudes * (scale * math.cos(math.radians(float(np.mean(latitudes)))))
+    y = latitudes * scale
+    return x, y
+
+def drop_stationary_points(x, y, min_distance):
+    """
+    Return the indices of the points that are at least min_distance meters
+    away from the previously kept point. The last point is always kept.
+    """
+    indices = [0]
+    last_x, last_y = x[0], y[0]
+    min_distance_squared = min_distance * min_distance
+    for index, (point_x, point_y) in enumerate(zip(x[1:].tolist(), y[1:].tolist()), start=1):
+        if (point_x - last_x) ** 2 + (point_y - last_y) ** 2 >= min_distance_squared:
+            indices.append(index)
+            last_x, last_y = point_x, point_y
+    if indices[-1] != len(x) - 1:
+        indices.append(len(x) - 1)
+    return np.array(indices, dtype=np.int64)
+
+def douglas_peucker(x, y, tolerance):
+    """
+    Return the indices of the points that are kept by the Douglas-Peucker
+    simplification with the given tolerance in meters.
+    """
+    keep = np.zeros(len(x), dtype=bool)
+    keep[0] = keep[-1] = True
+    ranges = [(0, len(x) - 1)]
+    while ranges:
+        first, last = ranges.pop()
+        if last - first < 2:
+            continue
+        # Distances of the inner points to the line between the first and the last point
+        dx, dy = x[last] - x[first], y[last] - y[first]
+        inner_x, inner_y = x[first + 1:last] - x[first], y[first + 1:last] - y[first]
+        length = math.hypot(dx, dy)
+        if length == 0:
+            distances = np.hypot(inner_x, inner_y)
+        else:
+            distances = np.abs(inner_x * dy - inner_y * dx) / length
+        farthest = int(np.argmax(distances))
+        if distances[farthest] > tolerance:
+            split = first + 1 + farthest
+            keep[split] = True
+            ranges.append((first, split))
+            ranges.append((split, last))
+    return np.flatnonzero(keep)
+
+class TrackSimplifier:
+    """
+    Reduce the points of a track before map matching: points within
+    min_distance meters of the previously kept point (e.g. waiting at a
+    traffic light) are dropped and the rest is simplified with
+    Douglas-Peucker. Only the map matching request uses the reduced points,
+    the speeds are still snapped from all GPS points.
+    """
+    def __init__(self, min_distance=3.0, tolerance=5.0):
+        self.min_distance = min_distance
+        self.tolerance = tolerance
+        self.lock = threading.Lock()
+        self.point_count = 0
+        self.kept_point_count = 0
+        
+    def simplify(self, longitudes, latitudes):
+        """
+        Return the indices of the points to keep.
+        """
+        if len(longitudes) < 3:
+            indices = np.arange(len(longitudes))
+        else:
+            x, y = project(longitudes, latitudes)
+            indices = drop_stationary_points(x, y, self.min_distance)
+            indices = indices[douglas_peucker(x[indices], y[indices], self.tolerance)]
+        with self.lock:
+            self.point_count += len(longitudes)
+            self.kept_point_count += len(indices)
+        return indices
+    
+    def print_stats(self):
+        reduction = 1 - self.kept_point_count / self.point_count if self.point_count else 0
+        print(f"Simplified {self.point_count} GPS points to {self.kept_point_count} for map matching ({100 * reduction:.1f}% fewer)")
@@ -0,0 +1,125 @@
+import numpy as np
+from array import array
+from functools import partial
+
+def finite_speeds(speeds):
+    # Missing speeds are parsed as NaN, they are not counted as samples
+    speeds = np.asarray(speeds, dtype=float)
+    return speeds[np.isfinite(speeds)].tolist()
+
+class ExactSpeeds:
+    """
+    Keep every speed sample of a segment. Needs memory proportional to the
+    number of samples, but is useful to validate the speed histograms.
+    """
+    __slots__ = ("speeds",)
+    
+    def __init__(self):
+        self.speeds = []
+        
+    def add(self, speeds):
+        self.speeds.extend(finite_speeds(speeds))
+        
+    def merge(self, other):
+        self.speeds.extend(other.speeds)
+        
+    def count(self):
+        return len(self.speeds)
+        
+    def median(self):
+        return np.median(self.speeds)
+    
+    def percentile(self, q):
+        return np.percentile(self.speeds, q)
+    
+    def to_json(self):
+        return self.speeds
+
+class SpeedHistogram:
+    """
+    Aggregate the speed samples of a segment in a histogram with fixed bins
+    of bin_width m/s between 0 and max_speed. Speeds outside of this range
+    are counted in the first or the last bin, NaN and infinite speeds are
+    dropped.
+    
+    As long as they need less memory than the histogram, the samples are
+    kept as they are, so percentiles of rarely used segments are exact.
+    Otherwise percentiles are accurate within half a bin width.
+    """
+    __slots__ = ("bin_width", "bin_count", "samples", "counts")
+    
+    def __init__(self, bin_width=0.25, max_speed=25.0):
+        self.bin_width = bin_width
+        self.bin_count = int(np.ceil(max_speed / bin_width))
+        self.samples = array("d")
+        self.counts = None
+        
+    def __bin(self, speeds):
+        bins = np.clip(np.floor(np.asarray(speeds, dtype=float) / self.bin_width), 0, self.bin_count - 1).astype(np.int64)
+        return np.bincount(bins, minlength=self.bin_count).astype(np.uint32)
+    
+    def __compact(self):
+        # The histogram uses 4 bytes per bin, the samples 8 bytes each
+        if self.counts is None and len(self.samples) > self.bin_count // 2:
+            self.counts = self.__bin(self.samples)
+            self.samples = None
+        
+    def add(self, speeds):
+        speeds = finite_speeds(speeds)
+        if self.counts is None:
+            self.samples.extend(speeds)
+            self.__compact()
+        else:
+            self.counts += self.__bin(speeds)
+            
+    def merge(self, other):
+        if self.bin_width != other.bin_width or self.bin_count != other.bin_count:
+            raise ValueError("Cannot merge speed histograms with different bins")
+        if other.counts is None:
+            self.add(other.samples)
+        elif self.counts is None:
+            self.counts = self.__bin(self.samples) + other.counts
+            self.samples = None
+        else:
+            self.counts += other.counts
+            
+    def count(self):
+        if self.counts is None:
+            return len(self.samples)
+        return int(self.counts.sum())
+    
+    def median(self):
+        if self.counts is None:
+            return np.median(self.samples)
+        return self.percentile(50)
+    
+    def percentile(self, q):
+        if self.counts is None:
+            return np.percentile(self.samples, q)
+        # Interpolate linearly between the bin centers, like np.percentile does between samples
+        rank = q / 100 * (self.count() - 1)
+        cumulative_counts = np.cumsum(self.counts)
+        lower = (np.searchsorted(cumulative_counts, np.floor(rank), side="right") + 0.5) * self.bin_width
+        upper = (np.searchsorted(cumulative_counts, np.ceil(rank), side="right") + 0.5) * self.bin_width
+        return float(lower + (rank - np.floor(rank)) * (upper - lower))
+    
+    def to_json(self):
+        if self.counts is None:
+            return self.samples.tolist()
+        bins = np.flatnonzero(self.counts)
+        return {
+            "bin_width": self.bin_width,
+            "bins": {f"{(b + 0.5) * self.bin_width:g}": int(self.counts[b]) for b in bins},
+        }
+
+def speed_aggregate_factory(mode="histogram", bin_width=0.25, max_speed=25.0):
+    """
+    Return a function that creates empty speed aggregates of the given mode,
+    either "histogram" or "exact". The function can be pickled, so it can be
+    passed to worker processes.
+    """
+    if mode == "exact":
+        return ExactSpeeds
+    if mode == "histogram":
+        return partial(SpeedHistogram, bin_width=bin_width, max_speed=max_speed)
+    raise ValueError(f"Unknown speed aggregate mode: {mode}")
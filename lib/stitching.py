@@ -0,0 +1,86 @@
+import numpy as np
+
+def pack_nodes(lngs, lats):
+    return (lngs.astype(np.int64) << 32) | (lats.astype(np.int64) & 0xFFFFFFFF)
+
+def speeds_within_tolerance(properties, other_properties, speed_tolerance):
+    """
+    Check if two segments have the same counts per profile and speeds that
+    differ by at most speed_tolerance m/s.
+    """
+    if properties["total_count"] != other_properties["total_count"]:
+        return False
+    if properties["profiles"].keys() != other_properties["profiles"].keys():
+        return False
+    speed_pairs = [
+        (properties[key], other_properties[key])
+        for key in ("total_median_speed_ms", "total_p15_speed_ms", "total_p85_speed_ms")
+    ]
+    for profile_key, profile in properties["profiles"].items():
+        other_profile = other_properties["profiles"][profile_key]
+        if profile["count"] != other_profile["count"]:
+            return False
+        speed_pairs.extend(
+            (profile[key], other_profile[key])
+            for key in ("median_speed_ms", "p15_speed_ms", "p85_speed_ms")
+        )
+    return all(abs(speed - other_speed) <= speed_tolerance for speed, other_speed in speed_pairs)
+
+def stitch_segments(segments, segment_ids, properties, speed_tolerance):
+    """
+    Group the given segments into chains of adjacent segments, where the
+    end of a segment is the start of the next one and no other segment
+    starts or ends at that point. A chain only continues with segments
+    whose properties are within the tolerance of its first segment, so the
+    speeds do not drift along a long street.
+    
+    Returns a list of chains, every chain is a list of segment ids.
+    """
+    segment_ids = np.asarray(segment_ids, dtype=np.int64)
+    coordinates = segments.coordinates[segment_ids]
+    start_nodes = pack_nodes(coordinates[:, 0], coordinates[:, 1])
+    end_nodes = pack_nodes(coordinates[:, 2], coordinates[:, 3])
+    
+    # Only nodes with exactly one incoming and one outgoing segment are inside a chain
+    nodes, node_indices = np.unique(np.concatenate([start_nodes, end_nodes]), return_inverse=True)
+    out_degrees = np.bincount(node_indices[:len(segment_ids)], minlength=len(nodes))
+    in_degrees = np.bincount(node_indices[len(segment_ids):], minlength=len(nodes))
+    end_node_indices = node_indices[len(segment_ids):]
+    inner_nodes = (out_degrees == 1) & (in_degrees == 1)
+    
+    starting_at = {node: row for row, node in enumerate(node_indices[:len(segment_ids)].tolist()) if inner_nodes[node]}
+    successors = [
+        starting_at.get(end_node, -1) if inner_nodes[end_node] else -1
+        for end_node in end_node_indices.tolist()
+    ]
+    has_predecessor = np.zeros(len(segment_ids), dtype=bool)
+    for successor in successors:
+        if successor >= 0:
+            has_predecessor[successor] = True
+    
+    visited = np.zeros(len(segment_ids), dtype=bool)
+    chains = []
+    
+    def walk(row):
+        # Follow the successors from the given row, returns the row at which
+        # a new chain has to start because the properties are too different
+        chain = [row]
+        visited[row] = True
+        first_properties = properties[segment_ids[row]]
+        successor = successors[row]
+        while successor >= 0 and not visited[successor]:
+            if not speeds_within_tolerance(first_properties, properties[segment_ids[successor]], speed_tolerance):
+                chains.append(chain)
+                return successor
+            chain.append(successor)
+            visited[successor] = True
+            successor = successors[successor]
+        chains.append(chain)
+        return None
+    
+    # Start at segments without a predecessor, the remaining rows are cycles
+    for row in np.concatenate([np.flatnonzero(~has_predecessor), np.arange(len(segment_ids))]).tolist():
+        while row is not None and not visited[row]:
+            row = walk(row)
+    
+    return [[int(segment_ids[row]) for row in chain] for chain in chains]
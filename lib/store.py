@@ -0,0 +1,288 @@
+import os
+import pickle
+import sqlite3
+import numpy as np
+from lib.segments import COORDINATE_SCALE, SegmentTable, merged_speeds
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS segments (
+    id INTEGER PRIMARY KEY,
+    start_lng INTEGER NOT NULL,
+    start_lat INTEGER NOT NULL,
+    end_lng INTEGER NOT NULL,
+    end_lat INTEGER NOT NULL,
+    traversal_count INTEGER NOT NULL,
+    total_count INTEGER NOT NULL,
+    total_speeds BLOB
+);
+CREATE UNIQUE INDEX IF NOT EXISTS segments_coordinates ON segments (start_lng, start_lat, end_lng, end_lat);
+CREATE TABLE IF NOT EXISTS profiles (
+    profile_column INTEGER PRIMARY KEY,
+    bike_type TEXT NOT NULL UNIQUE
+);
+CREATE TABLE IF NOT EXISTS profile_speeds (
+    segment_id INTEGER NOT NULL,
+    profile_column INTEGER NOT NULL,
+    count INTEGER NOT NULL,
+    speeds BLOB,
+    PRIMARY KEY (segment_id, profile_column)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS checkpoint (
+    id INTEGER PRIMARY KEY CHECK (id = 0),
+    state BLOB NOT NULL
+);
+"""
+
+def dump_speeds(speeds):
+    return None if speeds is None else pickle.dumps(speeds, protocol=pickle.HIGHEST_PROTOCOL)
+
+def load_speeds(blob):
+    return None if blob is None else pickle.loads(blob)
+
+class SqliteSegmentStore:
+    """
+    Segment aggregates in an SQLite database on disk, for time windows
+    whose segments do not fit into memory.
+
+    Batches of segments are upserted as SegmentTable, the segments keep
+    the ids in the order in which they were first upserted, and the
+    profiles the order in which they were first seen, so reading the
+    store gives the same tables as aggregating all segments in memory.
+    Reads stream over the segments in tables of batch_size segments.
+
+    Upserts are only durable after commit. save_checkpoint commits them
+    in one transaction with the checkpoint of the tracks they contain.
+    """
+    def __init__(self, path, create_speed_aggregate, batch_size=50000):
+        self.path = path
+        self.create_speed_aggregate = create_speed_aggregate
+        self.batch_size = batch_size
+        self.__connect()
+
+    @classmethod
+    def create(cls, path, create_speed_aggregate, batch_size=50000):
+        """
+        Create an empty store, replacing an existing one at the path.
+        """
+        cls.remove_files(path)
+        return cls(path, create_speed_aggregate, batch_size=batch_size)
+
+    @staticmethod
+    def remove_files(path):
+        for file_path in (path, f"{path}-journal"):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def __connect(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.connection = sqlite3.connect(self.path)
+        self.connection.executescript(SCHEMA)
+        # Rows of the upserted batch, to look up their stored ids with a join
+        self.connection.execute("CREATE TEMP TABLE batch (batch_row INTEGER PRIMARY KEY, start_lng INTEGER, start_lat INTEGER, end_lng INTEGER, end_lat INTEGER)")
+        self.connection.commit()
+        self.size = self.connection.execute("SELECT COUNT(*) FROM segments").fetchone()[0]
+        self.profile_names = [bike_type for bike_type, in self.connection.execute("SELECT bike_type FROM profiles ORDER BY profile_column")]
+
+    def __getstate__(self):
+        # The connection is not pickled, e.g. with a checkpoint, only the committed state is restored
+        return {"path": self.path, "create_speed_aggregate": self.create_speed_aggregate, "batch_size": self.batch_size}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__connect()
+
+    def __len__(self):
+        return self.size
+
+    def __profile_column(self, bike_type):
+        if bike_type not in self.profile_names:
+            self.connection.execute("INSERT INTO profiles VALUES (?, ?)", (len(self.profile_names), bike_type))
+            self.profile_names.append(bike_type)
+        return self.profile_names.index(bike_type)
+
+    def upsert(self, table):
+        """
+        Add the segments, counts and speeds of the table to the store. Like
+        SegmentTable.merge, the speed aggregates of the table are reused.
+        """
+        if len(table) == 0:
+            return
+        cursor = self.connection.cursor()
+        cursor.execute("DELETE FROM batch")
+        cursor.executemany("INSERT INTO batch VALUES (?, ?, ?, ?, ?)", ((row, *quantized_segment) for row, quantized_segment in enumerate(table.coordinates.tolist())))
+
+        traversal_counts = table.traversal_counts.tolist()
+        total_counts = table.total_counts.tolist()
+        total_speeds = list(table.total_speeds)
+        segment_ids = [None] * len(table)
+        existing = cursor.execute("""
+            SELECT batch.batch_row, segments.id, segments.traversal_count, segments.total_count, segments.total_speeds
+            FROM batch JOIN segments ON segments.start_lng = batch.start_lng AND segments.start_lat = batch.start_lat
+                AND segments.end_lng = batch.end_lng AND segments.end_lat = batch.end_lat
+        """).fetchall()
+        for row, segment_id, traversal_count, total_count, speeds in existing:
+            segment_ids[row] = segment_id
+            traversal_counts[row] += traversal_count
+            total_counts[row] += total_count
+            total_speeds[row] = merged_speeds(load_speeds(speeds), total_speeds[row])
+        # New segments are appended in the order of the table
+        for row in range(len(table)):
+            if segment_ids[row] is None:
+                segment_ids[row] = self.size
+                self.size += 1
+        cursor.executemany("INSERT OR REPLACE INTO segments VALUES (?, ?, ?, ?, ?, ?, ?, ?)", (
+            (segment_ids[row], *quantized_segment, traversal_counts[row], total_counts[row], dump_speeds(total_speeds[row]))
+            for row, quantized_segment in enumerate(table.coordinates.tolist())
+        ))
+
+        columns = [self.__profile_column(bike_type) for bike_type in table.profile_names]
+        existing_profiles = {
+            (row, column): (count, speeds)
+            for row, column, count, speeds in cursor.execute("""
+                SELECT batch.batch_row, profile_speeds.profile_column, profile_speeds.count, profile_speeds.speeds
+                FROM batch JOIN segments ON segments.start_lng = batch.start_lng AND segments.start_lat = batch.start_lat
+                    AND segments.end_lng = batch.end_lng AND segments.end_lat = batch.end_lat
+                JOIN profile_speeds ON profile_speeds.segment_id = segments.id
+            """)
+        }
+        profile_rows = []
+        for table_column, column in enumerate(columns):
+            counts = table.profile_counts[:, table_column]
+            for row in np.flatnonzero(counts > 0).tolist():
+                count = int(counts[row])
+                speeds = table.profile_speeds[table_column][row]
+                if (row, column) in existing_profiles:
+                    existing_count, existing_speeds = existing_profiles[(row, column)]
+                    count += existing_count
+                    speeds = merged_speeds(load_speeds(existing_speeds), speeds)
+                profile_rows.append((segment_ids[row], column, count, dump_speeds(speeds)))
+        cursor.executemany("INSERT OR REPLACE INTO profile_speeds VALUES (?, ?, ?, ?)", profile_rows)
+
+    def commit(self):
+        self.connection.commit()
+
+    def save_checkpoint(self, state):
+        """
+        Commit the pending upserts together with the pickled checkpoint state.
+        """
+        self.connection.execute("INSERT OR REPLACE INTO checkpoint VALUES (0, ?)", (state,))
+        self.connection.commit()
+
+    @staticmethod
+    def load_checkpoint(path):
+        """
+        Return the pickled checkpoint state of the store at the path, or None.
+        """
+        if not os.path.exists(path):
+            return None
+        connection = sqlite3.connect(path)
+        try:
+            row = connection.execute("SELECT state FROM checkpoint WHERE id = 0").fetchone()
+        except sqlite3.OperationalError:
+            row = None
+        finally:
+            connection.close()
+        return None if row is None else row[0]
+
+    def copy(self, path):
+        """
+        Write the committed segments to a new store file at the path, which
+        is replaced atomically. The checkpoint is not copied.
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        self.remove_files(tmp_path)
+        copy = sqlite3.connect(tmp_path)
+        try:
+            self.connection.backup(copy)
+            copy.execute("DELETE FROM checkpoint")
+            copy.commit()
+        finally:
+            copy.close()
+        os.replace(tmp_path, path)
+
+    def close(self):
+        self.connection.close()
+
+    def remove(self):
+        self.close()
+        self.remove_files(self.path)
+
+    def __table(self, first_id, last_id):
+        # Segments with first_id <= id < last_id, with the ids starting at 0 in the returned table
+        rows = self.connection.execute("SELECT start_lng, start_lat, end_lng, end_lat, traversal_count, total_count, total_speeds FROM segments WHERE id >= ? AND id < ? ORDER BY id", (first_id, last_id)).fetchall()
+        profile_counts = np.zeros((len(rows), len(self.profile_names)), dtype=np.int64)
+        profile_speeds = [[None] * len(rows) for _ in self.profile_names]
+        for segment_id, column, count, speeds in self.connection.execute("SELECT segment_id, profile_column, count, speeds FROM profile_speeds WHERE segment_id >= ? AND segment_id < ?", (first_id, last_id)):
+            profile_counts[segment_id - first_id, column] = count
+            profile_speeds[column][segment_id - first_id] = load_speeds(speeds)
+        return SegmentTable.from_columns(
+            self.create_speed_aggregate,
+            np.array([row[:4] for row in rows], dtype=np.int32).reshape(len(rows), 4),
+            [row[4] for row in rows],
+            [row[5] for row in rows],
+            self.profile_names,
+            profile_counts,
+            [load_speeds(row[6]) for row in rows],
+            profile_speeds,
+        )
+
+    def tables(self):
+        """
+        Iterate over the segments in tables of at most batch_size segments,
+        in the order of their ids.
+        """
+        for first_id in range(0, self.size, self.batch_size):
+            yield self.__table(first_id, first_id + self.batch_size)
+
+    def load(self):
+        """
+        Return all segments as one SegmentTable in memory.
+        """
+        return self.__table(0, self.size)
+
+    def filtered(self, select, path):
+        """
+        Stream the segments into a new store at the path. select is called
+        with every table of segments and returns the ids of the segments
+        in that table to keep.
+        """
+        store = SqliteSegmentStore.create(path, self.create_speed_aggregate, batch_size=self.batch_size)
+        for table in self.tables():
+            store.upsert(table.subset(select(table)))
+        store.commit()
+        return store
+
+    def key(self, segment_id):
+        """
+        Return the segment key as used in the JSON dumps, "startlng_startlat_endlng_endlat".
+        """
+        quantized_segment = self.connection.execute("SELECT start_lng, start_lat, end_lng, end_lat FROM segments WHERE id = ?", (segment_id,)).fetchone()
+        return "_".join(str(value / COORDINATE_SCALE) for value in quantized_segment)
+
+    def count_mismatch(self):
+        """
+        Return the id of a segment whose total count does not match the sum
+        of the counts of its profiles, or None.
+        """
+        row = self.connection.execute("""
+            SELECT segments.id FROM segments
+            LEFT JOIN (SELECT segment_id, SUM(count) AS count FROM profile_speeds GROUP BY segment_id) AS profiles ON profiles.segment_id = segments.id
+            WHERE segments.total_count != COALESCE(profiles.count, 0)
+            LIMIT 1
+        """).fetchone()
+        return None if row is None else row[0]
+
+    def meta_stats(self):
+        """
+        Return the number of traversals, of processed segments, of traversals
+        of unprocessed segments and of unprocessed segments.
+        """
+        return tuple(value or 0 for value in self.connection.execute("""
+            SELECT SUM(traversal_count), SUM(total_count > 0),
+                SUM(CASE WHEN total_count = 0 THEN traversal_count ELSE 0 END),
+                SUM(total_count = 0 AND traversal_count > 0)
+            FROM segments
+        """).fetchone())
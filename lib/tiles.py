@@ -0,0 +1,73 @@
+import numpy as np
+from lib.segments import COORDINATE_SCALE
+
+# Web Mercator is undefined at the poles, latitudes are clamped like in slippy map tiles
+MAX_LATITUDE = 85.0511287798
+
+def tile_positions(longitudes, latitudes, zoom):
+    """
+    Return the web mercator positions of the given points in units of
+    tiles, the integer part is the z/x/y tile index.
+    """
+    tile_count = 2 ** zoom
+    latitudes = np.radians(np.clip(latitudes, -MAX_LATITUDE, MAX_LATITUDE))
+    x = (np.asarray(longitudes) + 180.0) / 360.0 * tile_count
+    y = (1.0 - np.arcsinh(np.tan(latitudes)) / np.pi) / 2.0 * tile_count
+    return x, y
+
+def tile_indices(x, y, zoom):
+    tile_count = 2 ** zoom
+    return (
+        np.clip(np.floor(x), 0, tile_count - 1).astype(np.int64),
+        np.clip(np.floor(y), 0, tile_count - 1).astype(np.int64),
+    )
+
+def crossed_tiles(start_x, start_y, end_x, end_y, zoom):
+    """
+    Return the x and y indices of the tiles that the straight line between
+    two tile positions passes through, the line is straight in web mercator.
+    """
+    # The line enters a new tile at every integer x or y it crosses, the tile
+    # between two crossings is the one that contains the middle of that part
+    crossings = [0.0, 1.0]
+    for start, end in ((start_x, end_x), (start_y, end_y)):
+        low, high = sorted((start, end))
+        crossings.extend((boundary - start) / (end - start) for boundary in range(int(np.floor(low)) + 1, int(np.ceil(high))))
+    crossings = np.unique(crossings)
+    middles = (crossings[:-1] + crossings[1:]) / 2
+    return tile_indices(start_x + middles * (end_x - start_x), start_y + middles * (end_y - start_y), zoom)
+
+def tile_segments(segments, segment_ids, zoom):
+    """
+    Assign the segments with the given ids to every tile that they pass
+    through. Returns a dict of (x, y) to the segment ids in that tile.
+    """
+    segment_ids = np.asarray(segment_ids, dtype=np.int64)
+    coordinates = segments.coordinates[segment_ids] / COORDINATE_SCALE
+    start_positions = tile_positions(coordinates[:, 0], coordinates[:, 1], zoom)
+    end_positions = tile_positions(coordinates[:, 2], coordinates[:, 3], zoom)
+    start_x, start_y = tile_indices(*start_positions, zoom)
+    end_x, end_y = tile_indices(*end_positions, zoom)
+    
+    # A segment that crosses a tile border is written to all tiles it passes.
+    # Most segments are within one tile or cross into a neighbouring one, only
+    # longer segments can pass tiles in between and are traced tile by tile.
+    tile_x = [start_x, end_x]
+    tile_y = [start_y, end_y]
+    tile_segment_ids = [segment_ids, segment_ids]
+    for row in np.flatnonzero(np.abs(end_x - start_x) + np.abs(end_y - start_y) > 1).tolist():
+        x, y = crossed_tiles(start_positions[0][row], start_positions[1][row], end_positions[0][row], end_positions[1][row], zoom)
+        tile_x.append(x)
+        tile_y.append(y)
+        tile_segment_ids.append(np.full(len(x), segment_ids[row]))
+    tile_x = np.concatenate(tile_x)
+    tile_y = np.concatenate(tile_y)
+    tile_segment_ids = np.concatenate(tile_segment_ids)
+    tile_keys = np.unique(np.stack([tile_x, tile_y, tile_segment_ids], axis=1), axis=0)
+    
+    tiles = {}
+    boundaries = np.flatnonzero(np.any(np.diff(tile_keys[:, :2], axis=0) != 0, axis=1)) + 1
+    for rows in np.split(tile_keys, boundaries):
+        if len(rows) > 0:
+            tiles[(int(rows[0, 0]), int(rows[0, 1]))] = rows[:, 2]
+    return tiles
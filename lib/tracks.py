@@ -1,42 +1,155 @@
-import requests
+import csv
+import threading
+import time
+import warnings
+import numpy as np
 import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
 from io import StringIO
+from lib.metrics import metrics
+from lib.pipeline import ordered_map
+from lib.session import create_session
+
+# Columns of the GPS CSV that are needed for map matching and snapping
+REQUIRED_COLUMNS = ("longitude", "latitude", "speed")
+TIMESTAMP_COLUMN = "timestamp"
+
+# Reasons why a track can not be processed
+TOO_SHORT = "too_short"
+MISSING_COLUMNS = "missing_columns"
+INVALID_COORDINATES = "invalid_coordinates"
+
+class Track:
+    """
+    A track with its GPS data as float arrays. Tracks that failed the
+    validation have an error and no GPS data.
+    """
+    __slots__ = ("pk", "session_id", "user_id", "bike_type", "longitudes", "latitudes", "speeds", "timestamps", "error")
+    
+    def __init__(self, pk, session_id, user_id, bike_type, longitudes=None, latitudes=None, speeds=None, timestamps=None, error=None):
+        self.pk = pk
+        self.session_id = session_id
+        self.user_id = user_id
+        self.bike_type = bike_type
+        self.longitudes = longitudes
+        self.latitudes = latitudes
+        self.speeds = speeds
+        self.timestamps = timestamps
+        self.error = error
+        
+    def __len__(self):
+        return 0 if self.longitudes is None else len(self.longitudes)
+    
+    @property
+    def nbytes(self):
+        arrays = (self.longitudes, self.latitudes, self.speeds, self.timestamps)
+        return sum(array.nbytes for array in arrays if array is not None)
+    
+    def __str__(self):
+        return f"Track: pk {self.pk}, sessionId {self.session_id}, userId {self.user_id}"
+
+def parse_gps_csv(gps_csv):
+    """
+    Parse the longitude, latitude and speed columns and, if available, the
+    timestamp column of a GPS CSV. Returns (longitudes, latitudes, speeds,
+    timestamps, error), where error is TOO_SHORT, MISSING_COLUMNS or
+    INVALID_COORDINATES if the track can not be processed. GPS points
+    without a speed are dropped, tracks with missing timestamps are
+    returned without timestamps.
+    """
+    header = [column.strip() for column in next(csv.reader(StringIO(gps_csv.split("\n", 1)[0])), [])]
+    if any(column not in header for column in REQUIRED_COLUMNS):
+        # Short tracks are too short before their columns are validated
+        if not gps_csv.strip() or len(pd.read_csv(StringIO(gps_csv))) < 2:
+            return None, None, None, None, TOO_SHORT
+        return None, None, None, None, MISSING_COLUMNS
+    columns = list(REQUIRED_COLUMNS)
+    if TIMESTAMP_COLUMN in header:
+        columns.append(TIMESTAMP_COLUMN)
+    
+    # The tracks are small, for them the C parser of NumPy is much faster than
+    # pandas. Every column ends up as a contiguous row of one array.
+    try:
+        with warnings.catch_warnings():
+            # Tracks without any GPS point warn about the empty input
+            warnings.simplefilter("ignore", UserWarning)
+            gps_data = np.ascontiguousarray(np.loadtxt(StringIO(gps_csv), delimiter=",", skiprows=1, usecols=[header.index(column) for column in columns], dtype=np.float64, ndmin=2, unpack=True))
+    except ValueError:
+        # Empty or quoted fields are left to pandas
+        gps_data = pd.read_csv(StringIO(gps_csv)).rename(columns=str.strip)[columns].to_numpy(dtype=np.float64).T.copy()
+    # Points without a speed sample can not be aggregated
+    if not np.isfinite(gps_data[2]).all():
+        gps_data = np.ascontiguousarray(gps_data[:, np.isfinite(gps_data[2])])
+    if gps_data.shape[1] < 2:
+        return None, None, None, None, TOO_SHORT
+    if not np.isfinite(gps_data[:2]).all():
+        return None, None, None, None, INVALID_COORDINATES
+    
+    # Millisecond timestamps are exact in float64, missing ones can not be cast
+    timestamps = None
+    if len(columns) > 3 and np.isfinite(gps_data[3]).all():
+        timestamps = gps_data[3].astype(np.int64)
+    return gps_data[0], gps_data[1], gps_data[2], timestamps, None
 
 def fetch_tracks(
     tracking_service_url,
     tracking_service_api_key,
     start_time,
     end_time,
+    workers=8,
+    skip_pks=frozenset(),
 ):  
-    # Fetch the paginated data from the tracking service
+    session = create_session(pool_size=workers)
+    
+    # Fetch the paginated data from the tracking service, without the tracks to skip
     def fetch():
         tracking_base_url = f'{tracking_service_url}/tracks/list/?key={tracking_service_api_key}&pageSize=100&from={start_time}&to={end_time}'
-        response = requests.get(tracking_base_url)
-        tracking_data = response.json()
+        with metrics.time("tracking_service_list"):
+            tracking_data = session.get(tracking_base_url).json()
         for track in tracking_data['results']:
-            yield track
+            if track["pk"] not in skip_pks:
+                yield track
         tracking_page_count = tracking_data['totalPages']
         for page in range(2, tracking_page_count + 1):
             print(f'Page {page} of {tracking_page_count}...')
-            tracking_data = requests.get(f'{tracking_base_url}&page={page}').json()
+            with metrics.time("tracking_service_list"):
+                tracking_data = session.get(f'{tracking_base_url}&page={page}').json()
             for track in tracking_data['results']:
-                yield track
-                
-    tracks = []
-    bike_types = []
-    gps_data = []
-                                
-    # Resolve each track with its raw GPS data
-    for track in fetch():
+                if track["pk"] not in skip_pks:
+                    yield track
+    
+    parse_stats = {"tracks": 0, "points": 0, "seconds": 0.0, "bytes": 0}
+    parse_stats_lock = threading.Lock()
+    
+    # Resolve a single track with its parsed and validated GPS data
+    def resolve(track):
         pk = track["pk"]
-        raw = requests.get(f'{tracking_service_url}/tracks/fetch/?key={tracking_service_api_key}&pk={pk}').json()
-        gps_df = pd.read_csv(StringIO(raw['gpsCSV']))
+        with metrics.time("tracking_service_fetch"):
+            raw = session.get(f'{tracking_service_url}/tracks/fetch/?key={tracking_service_api_key}&pk={pk}').json()
+        start = time.perf_counter()
+        longitudes, latitudes, speeds, timestamps, error = parse_gps_csv(raw['gpsCSV'])
+        parse_seconds = time.perf_counter() - start
+        metrics.observe("csv_parse", parse_seconds)
         if "bikeType" not in raw["metadata"]:
             bike_type = "unavailable"
         else:
             bike_type = str(raw["metadata"]["bikeType"])
-        tracks.append(track)
-        bike_types.append(bike_type)
-        gps_data.append(gps_df)
-        
-    return zip(tracks, bike_types, gps_data)
\ No newline at end of file
+        resolved_track = Track(pk, track["sessionId"], track["userId"], bike_type, longitudes, latitudes, speeds, timestamps, error)
+        metrics.increment("tracks_fetched")
+        metrics.increment("gps_points_fetched", len(resolved_track))
+        with parse_stats_lock:
+            parse_stats["tracks"] += 1
+            parse_stats["points"] += len(resolved_track)
+            parse_stats["seconds"] += parse_seconds
+            parse_stats["bytes"] += resolved_track.nbytes
+        return resolved_track
+
+    # Resolve the tracks concurrently while the next list pages are fetched.
+    # The tracks are yielded lazily in the order of the list pages, so only
+    # the tracks that are currently in flight are held in memory.
+    with session, ThreadPoolExecutor(max_workers=workers) as executor:
+        yield from ordered_map(executor, resolve, fetch(), max_pending=2 * workers)
+    
+    if parse_stats["tracks"] > 0:
+        print(f"Parsed {parse_stats['tracks']} tracks with {parse_stats['points']} GPS points in {parse_stats['seconds']:.2f} s ({1000 * parse_stats['seconds'] / parse_stats['tracks']:.2f} ms per track)")
+        print(f"GPS arrays: {parse_stats['bytes'] / parse_stats['tracks'] / 1000:.1f} kB per track, {parse_stats['bytes'] / max(parse_stats['points'], 1):.0f} bytes per point")
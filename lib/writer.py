@@ -0,0 +1,228 @@
+import gzip
+import json
+import os
+import numpy as np
+from array import array
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+    
+# brotli is in requirements.txt, without it only .gz siblings are written
+BROTLI_AVAILABLE = brotli is not None
+
+# Writes to the compressors are batched, compressing every feature on its own is slow
+BUFFER_SIZE = 64 * 1024
+
+class CompressingFile:
+    """
+    Binary file that is written together with a .gz and, if the brotli
+    package is installed, a .br sibling, so nginx can serve them with
+    gzip_static and brotli_static.
+    
+    All files are written as .tmp files first. close renames them to their
+    final paths, the file itself last, while discard removes them, so an
+    interrupted write never leaves a truncated file under the final path.
+    """
+    def __init__(self, path, compress=True):
+        self.path = path
+        self.paths = [path]
+        if compress:
+            self.paths.append(f"{path}.gz")
+            if brotli is not None:
+                self.paths.append(f"{path}.br")
+        self.size = 0
+        self.file = open(f"{path}.tmp", 'wb')
+        # The gzip header names the final file, not the .tmp file
+        self.gzip_raw_file = open(f"{path}.gz.tmp", 'wb') if compress else None
+        self.gzip_file = gzip.GzipFile(f"{path}.gz", 'wb', compresslevel=9, fileobj=self.gzip_raw_file) if compress else None
+        self.brotli_file = open(f"{path}.br.tmp", 'wb') if compress and brotli is not None else None
+        self.brotli_compressor = brotli.Compressor(quality=9) if self.brotli_file is not None else None
+        self.buffer = []
+        self.buffer_size = 0
+        
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffer_size += len(data)
+        self.size += len(data)
+        if self.buffer_size >= BUFFER_SIZE:
+            self.flush()
+            
+    def flush(self):
+        data = b"".join(self.buffer)
+        self.buffer = []
+        self.buffer_size = 0
+        self.file.write(data)
+        if self.gzip_file is not None:
+            self.gzip_file.write(data)
+        if self.brotli_compressor is not None:
+            self.brotli_file.write(self.brotli_compressor.process(data))
+        
+    def finish(self):
+        """
+        Write the remaining data to the .tmp files, without renaming them yet.
+        """
+        self.flush()
+        self.file.close()
+        if self.gzip_file is not None:
+            self.gzip_file.close()
+            self.gzip_raw_file.close()
+        if self.brotli_compressor is not None:
+            self.brotli_file.write(self.brotli_compressor.finish())
+            self.brotli_file.close()
+            
+    def publish(self):
+        # The file itself is renamed last, it marks the output as complete
+        for path in reversed(self.paths):
+            os.replace(f"{path}.tmp", path)
+            
+    def close(self):
+        self.finish()
+        self.publish()
+        
+    def discard(self):
+        for f in (self.file, self.gzip_file, self.gzip_raw_file, self.brotli_file):
+            if f is not None:
+                f.close()
+        for path in self.paths:
+            if os.path.exists(f"{path}.tmp"):
+                os.remove(f"{path}.tmp")
+
+class PackedFeatureColumns:
+    """
+    Compact columnar encoding of the segment features. The file starts with
+    the magic bytes PSEG, the length of a JSON header as little endian
+    uint32 and the JSON header, which names the columns with their dtype,
+    byte offset and length. The columns follow as little endian arrays:
+
+    - vertex_offsets (uint32): index of the first vertex of every feature, plus the total vertex count
+    - coordinates (int32): lng, lat of every vertex, multiplied by the coordinate_scale of the header
+    - total_count (uint32) and total_median/p15/p85_speed_ms (float32)
+    - {profile}_count (uint32) and {profile}_median/p15/p85_speed_ms (float32)
+      for every profile, the speeds are NaN where the profile has no count
+    """
+    MAGIC = b"PSEG"
+    COORDINATE_SCALE = 10 ** 7
+    SPEED_KEYS = ("median_speed_ms", "p15_speed_ms", "p85_speed_ms")
+    
+    def __init__(self, properties):
+        self.properties = properties
+        self.feature_count = 0
+        self.vertex_offsets = array('I', [0])
+        self.coordinates = array('i')
+        self.total_counts = array('I')
+        self.total_speeds = {key: array('f') for key in self.SPEED_KEYS}
+        self.profile_counts = {}
+        self.profile_speeds = {}
+        
+    def add(self, feature):
+        for lng, lat in feature["geometry"]["coordinates"]:
+            self.coordinates.append(round(lng * self.COORDINATE_SCALE))
+            self.coordinates.append(round(lat * self.COORDINATE_SCALE))
+        self.vertex_offsets.append(len(self.coordinates) // 2)
+        
+        properties = feature["properties"]
+        self.total_counts.append(properties["total_count"])
+        for key in self.SPEED_KEYS:
+            self.total_speeds[key].append(properties[f"total_{key}"])
+        for profile_key in properties["profiles"]:
+            if profile_key not in self.profile_counts:
+                # Profiles that appear later are padded for the previous features
+                self.profile_counts[profile_key] = array('I', [0] * self.feature_count)
+                self.profile_speeds[profile_key] = {key: array('f', [np.nan] * self.feature_count) for key in self.SPEED_KEYS}
+        for profile_key, counts in self.profile_counts.items():
+            profile = properties["profiles"].get(profile_key)
+            counts.append(profile["count"] if profile is not None else 0)
+            for key in self.SPEED_KEYS:
+                self.profile_speeds[profile_key][key].append(profile[key] if profile is not None else np.nan)
+        self.feature_count += 1
+        
+    def columns(self):
+        yield "vertex_offsets", self.vertex_offsets
+        yield "coordinates", self.coordinates
+        yield "total_count", self.total_counts
+        for key in self.SPEED_KEYS:
+            yield f"total_{key}", self.total_speeds[key]
+        for profile_key, counts in self.profile_counts.items():
+            yield f"{profile_key}_count", counts
+            for key in self.SPEED_KEYS:
+                yield f"{profile_key}_{key}", self.profile_speeds[profile_key][key]
+        
+    def write(self, path, compress=True):
+        header = dict(self.properties, feature_count=self.feature_count, coordinate_scale=self.COORDINATE_SCALE, profiles=list(self.profile_counts), columns=[])
+        dtypes = {'I': "<u4", 'i': "<i4", 'f': "<f4"}
+        offset = 0
+        column_data = []
+        for name, column in self.columns():
+            data = np.frombuffer(column, dtype=column.typecode).astype(dtypes[column.typecode]).tobytes()
+            header["columns"].append({"name": name, "dtype": dtypes[column.typecode], "offset": offset, "length": len(column)})
+            column_data.append(data)
+            offset += len(data)
+        header_data = json.dumps(header).encode()
+        
+        f = CompressingFile(path, compress=compress)
+        try:
+            f.write(self.MAGIC)
+            f.write(len(header_data).to_bytes(4, "little"))
+            f.write(header_data)
+            for data in column_data:
+                f.write(data)
+            f.close()
+        except BaseException:
+            f.discard()
+            raise
+        return f.size
+
+class FeatureCollectionWriter:
+    """
+    Stream the features of a GeoJSON FeatureCollection to disk, one feature
+    at a time, in the same format as json.dump of the whole collection.
+    Optionally, the features are also written in the packed columnar encoding.
+    If the writer is left with an exception, no file is written.
+    """
+    def __init__(self, path, properties, compress=True, packed_path=None):
+        self.file = CompressingFile(path, compress=compress)
+        self.compress = compress
+        self.packed_path = packed_path
+        self.packed_columns = PackedFeatureColumns(properties) if packed_path is not None else None
+        self.feature_count = 0
+        self.features_size = 0
+        self.file.write(f'{{"type": "FeatureCollection", "properties": {json.dumps(properties)}, "features": ['.encode())
+        
+    def write(self, feature):
+        size = self.file.size
+        if self.feature_count > 0:
+            self.file.write(b", ")
+        self.file.write(json.dumps(feature).encode())
+        self.features_size += self.file.size - size
+        self.feature_count += 1
+        if self.packed_columns is not None:
+            self.packed_columns.add(feature)
+    
+    def close(self):
+        try:
+            self.file.write(b"]}")
+            self.file.finish()
+            if self.packed_columns is not None:
+                self.packed_columns.write(self.packed_path, compress=self.compress)
+        except BaseException:
+            self.file.discard()
+            raise
+        self.file.publish()
+        
+    def discard(self):
+        self.file.discard()
+            
+    @property
+    def size(self):
+        return self.file.size
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.discard()
@@ -1,13 +1,32 @@
 import argparse
 import time
-import requests
 import json
+import multiprocessing
 import os
 import numpy as np
-from lib.geo import snap, haversine_distance
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from functools import partial
+from lib.geo import snap_track
 from lib.debug import DataExchangeDebugger
-from lib.tracks import fetch_tracks
+from lib.tracks import INVALID_COORDINATES, MISSING_COLUMNS, TOO_SHORT, fetch_tracks
 from lib.output import SegmentProcessingOutput
+from lib.pipeline import batched, ordered_map, prefetch
+from lib.speeds import speed_aggregate_factory
+from lib.buckets import parse_duration, parse_time, split_into_buckets
+from lib.cache import MapMatchingCache
+from lib.checkpoint import Checkpointer
+from lib.layers import AggregateStore
+from lib.tiles import tile_segments
+from lib.stitching import stitch_segments
+from lib.writer import BROTLI_AVAILABLE, FeatureCollectionWriter
+from lib.matching import MapMatcher
+from lib.metrics import metrics
+from lib.payload import encode_track
+from lib.simplify import TrackSimplifier
+from lib.store import SqliteSegmentStore
+
+# Number of tracks that are snapped at once by a worker process
+SNAPPING_BATCH_SIZE = 32
 
 def current_milli_time():
     return round(time.time() * 1000)
@@ -25,249 +44,586 @@ def get_time_of_last_bucket():
         last_time = 1672531200000
     return last_time
 
-def process_segments(tracking_service_url, tracking_service_api_key, graphhopper_service_url, start_time, end_time, use_debugging=False):
-    tracks = fetch_tracks(tracking_service_url, tracking_service_api_key, start_time, end_time)
-    
-    data_exchange_debugger = DataExchangeDebugger(active=use_debugging)
-    output = SegmentProcessingOutput()
-
-    track_idx = 0
-    for track, bike_type, gps_data in tracks:
-        if track_idx % 100 == 0:
-            print(f"{track_idx} tracks processed")
-        
-        # Skip too short or invalid tracks
-        if len(gps_data) < 2:
+def valid_tracks(tracks, output, checkpointer):
+    for track in tracks:
+        # Skip too short or invalid tracks, they were validated when they were parsed
+        if track.error == TOO_SHORT:
             output.too_short_tracks_count += 1
+            metrics.increment("tracks_too_short")
+            checkpointer.complete(track.pk)
             continue
-        if 'latitude' not in gps_data.columns or 'longitude' not in gps_data.columns:
-            print("No latitude or longitude in gps data")
-            print(f"Track: pk {track['pk']}, sessionId {track['sessionId']}, userId {track['userId']}")
+        if track.error == MISSING_COLUMNS:
+            print("No latitude, longitude or speed in gps data")
+            print(track)
             output.invalid_tracks_count += 1
+            metrics.increment("tracks_invalid")
+            checkpointer.complete(track.pk)
             continue
-        data_exchange_debugger.new_geojson()
-        
-        gpx = "<gpx><trk><trkseg>"
-        for _, coordinates in gps_data.iterrows():
-            gpx += f"<trkpt lat=\"{coordinates['latitude']}\" lon=\"{coordinates['longitude']}\"></trkpt>"
-            data_exchange_debugger.add_track_point(coordinates['longitude'], coordinates['latitude'])
-        gpx += "</trkseg></trk></gpx>"
-        
-        # Send to graphhopper map matching api
-        response = requests.post(
-            f"{graphhopper_service_url}/match?profile=bike2_default&points_encoded=false&instructions=false",
-            data=gpx, 
-            headers={'Content-Type': 'application/gpx+xml'},
-        )
-        
-        response_data = response.json()
-        
-        if "paths" not in response_data:
-            print("Error in GraphHopper response")
-            print(f"Track: pk {track['pk']}, sessionId {track['sessionId']}, userId {track['userId']}")
-            output.tracks_with_map_matching_error_count += 1
+        if track.error == INVALID_COORDINATES:
+            print("Missing or invalid latitude or longitude in gps data")
+            print(track)
+            output.invalid_tracks_count += 1
+            metrics.increment("tracks_invalid")
+            checkpointer.complete(track.pk)
             continue
-        
-        if len(response_data["paths"]) != 1:
-            print("Invalid number of paths in GraphHopper response")
-            print(f"Track: pk {track['pk']}, sessionId {track['sessionId']}, userId {track['userId']}")
-            output.tracks_with_invalid_map_matching_count += 1
+        yield track
+
+def matching_mode(simplifier):
+    # Suffix of the map matching metrics, to compare runs with and without simplification
+    return "full" if simplifier is None else "simplified"
+
+def map_match(map_matcher, include_timestamps, simplifier, track):
+    # Only the request is simplified, the speeds are snapped from all GPS points
+    indices = None
+    if simplifier is not None:
+        with metrics.time("simplify"):
+            indices = simplifier.simplify(track.longitudes, track.latitudes)
+    with metrics.time("payload_encode"):
+        gpx = encode_track(track, include_timestamps=include_timestamps, indices=indices)
+    
+    # Send to graphhopper map matching api
+    with metrics.time(f"map_matching_{matching_mode(simplifier)}"):
+        return track, map_matcher.match(gpx)
+
+def snap_to_segments(output, track, points, track_debugger=None):
+    # Returns the number of segments that GPS points were snapped to
+    snapped_segment_count = 0
+    longitudes, latitudes = track.longitudes, track.latitudes
+    for segment, speeds_on_segment, gps_point_indices in snap_track(points, longitudes, latitudes, track.speeds):
+        output.add_segment(segment)
+        if len(speeds_on_segment) == 0:
             continue
-        
-        points = response_data["paths"][0]["points"]["coordinates"]
-        
-        for point in points:
-            data_exchange_debugger.add_map_matched_point(point[0], point[1])
-        
-        gps_point_idx = 0
-        
-        for point_idx in range(len(points) - 1):
-            # Anonyimze by skipping the first and last segment
-            if point_idx == 0 or point_idx >= len(points) - 2:
-                continue
-                      
-            point_lng_lat = (points[point_idx][0], points[point_idx][1])
-            next_point_lng_lat = (points[point_idx + 1][0], points[point_idx + 1][1])
-            segment = (point_lng_lat, next_point_lng_lat)
+        if track_debugger is not None:
+            for gps_point_idx in gps_point_indices:
+                track_debugger.add_snapping_line(segment, longitudes[gps_point_idx].item(), latitudes[gps_point_idx].item())
+        output.add_processed_segment(segment, track.bike_type, speeds_on_segment)
+        snapped_segment_count += 1
+    return snapped_segment_count
+
+def snap_batch(create_speed_aggregate, batch):
+    # Runs in a worker process, the partial output is merged by the main process
+    start = time.perf_counter()
+    output = SegmentProcessingOutput(create_speed_aggregate=create_speed_aggregate)
+    snapped_segment_count = 0
+    for _, track, points, _ in batch:
+        snapped_segment_count += snap_to_segments(output, track, points)
+    return output, [track.pk for _, track, _, _ in batch], snapped_segment_count, time.perf_counter() - start
+
+def print_matching_stats(mode):
+    latency = metrics.histogram(f"map_matching_{mode}")
+    tracks = metrics.count("tracks_processed")
+    matched = metrics.count(f"matched_segments_{mode}")
+    snapped = metrics.count(f"snapped_segments_{mode}")
+    print(f"Map matching of {mode} tracks: mean {1000 * latency.sum / max(latency.count, 1):.0f} ms, p90 {1000 * latency.percentile(90):.0f} ms per track")
+    print(f"Matched {matched} segments and snapped to {snapped} segments ({matched / max(tracks, 1):.1f} and {snapped / max(tracks, 1):.1f} per track)")
+
+@metrics.timed("process_segments")
+def process_segments(tracking_service_url, tracking_service_api_key, graphhopper_service_url, start_time, end_time, use_debugging=False, debug_sample_every=1, debug_sample_pks=None, debug_batch_size=100, fetch_workers=8, queue_size=32, map_matching_workers=16, map_matching_cache=None, map_matching_timestamps=False, simplify_distance=None, simplify_tolerance=None, create_speed_aggregate=None, workers=1, segment_store_dir=None, segment_store_batch_size=50000, checkpointer=None):
+    if use_debugging and workers > 1:
+        print("Debugging is only supported with a single worker, falling back to one worker")
+        workers = 1
+    
+    data_exchange_debugger = DataExchangeDebugger(active=use_debugging, sample_every=debug_sample_every, sample_pks=debug_sample_pks, batch_size=debug_batch_size)
+    
+    # Continue with the partial output of a resumed checkpoint, the completed tracks are skipped
+    if checkpointer is None:
+        checkpointer = Checkpointer()
+    if checkpointer.output is None:
+        segment_store = None
+        if segment_store_dir:
+            segment_store = SqliteSegmentStore.create(get_segment_store_path(segment_store_dir, start_time, end_time), create_speed_aggregate, batch_size=segment_store_batch_size)
+        checkpointer.start(start_time, end_time, SegmentProcessingOutput(create_speed_aggregate=create_speed_aggregate, store=segment_store, flush_size=segment_store_batch_size))
+    output = checkpointer.output
+    
+    # The tracks are streamed through the pipeline fetch -> map matching -> snapping.
+    # Fetching runs on a background thread and map matching on a thread pool,
+    # each stage holds at most queue_size tracks, so a slow stage blocks the
+    # previous ones instead of buffering the whole time window.
+    tracks = fetch_tracks(tracking_service_url, tracking_service_api_key, start_time, end_time, workers=fetch_workers, skip_pks=frozenset(checkpointer.completed_pks))
+    tracks = valid_tracks(prefetch(tracks, max_size=queue_size), output, checkpointer)
+    
+    # The map matcher adapts the number of concurrent requests to GraphHopper,
+    # the results are still consumed in track order.
+    map_matcher = MapMatcher(graphhopper_service_url, max_concurrency=map_matching_workers, cache=map_matching_cache)
+    simplifier = None
+    if simplify_tolerance is not None:
+        simplifier = TrackSimplifier(min_distance=simplify_distance, tolerance=simplify_tolerance)
+    mode = matching_mode(simplifier)
+    map_matching_executor = ThreadPoolExecutor(max_workers=map_matching_workers)
+    matched_tracks = ordered_map(
+        map_matching_executor,
+        partial(map_match, map_matcher, map_matching_timestamps, simplifier),
+        tracks,
+        max_pending=queue_size + map_matching_workers,
+    )
+    
+    def tracks_to_snap():
+        track_idx = 0
+        for track, response_data in matched_tracks:
+            if track_idx % 100 == 0:
+                print(f"{track_idx} tracks processed")
             
-            output.add_segment(segment)
+            track_debugger = data_exchange_debugger.start_track(track_idx, track.pk)
+            if track_debugger is not None:
+                track_debugger.add_track_points(track.longitudes.tolist(), track.latitudes.tolist())
             
-            if gps_point_idx >= len(gps_data.index):
+            if "paths" not in response_data:
+                print("Error in GraphHopper response")
+                print(track)
+                output.tracks_with_map_matching_error_count += 1
+                metrics.increment("tracks_map_matching_error")
+                checkpointer.complete(track.pk)
                 continue
             
-            if point_idx < len(points) - 2:
-                next_next_point_lng_lat = (points[point_idx + 2][0], points[point_idx + 2][1])
-                next_segment = (next_point_lng_lat, next_next_point_lng_lat)
-            else:
-                next_segment = None
-            
-            gpx_point_on_segment = True
-            
-            speeds_on_segment = []
-            speeds_on_segment.append(gps_data.iloc[[gps_point_idx]]["speed"].item())
-            data_exchange_debugger.add_snapping_line(segment, gps_data.iloc[[gps_point_idx]]["longitude"].item(), gps_data.iloc[[gps_point_idx]]["latitude"].item())
-            gps_point_idx += 1
+            if len(response_data["paths"]) != 1:
+                print("Invalid number of paths in GraphHopper response")
+                print(track)
+                output.tracks_with_invalid_map_matching_count += 1
+                metrics.increment("tracks_invalid_map_matching")
+                checkpointer.complete(track.pk)
+                continue
             
-            while gpx_point_on_segment and gps_point_idx < len(gps_data.index) - 2:
-                if next_segment is None:
-                    speeds_on_segment.append(gps_data.iloc[[gps_point_idx]]["speed"].item())
-                    data_exchange_debugger.add_snapping_line(segment, gps_data.iloc[[gps_point_idx]]["longitude"].item(), gps_data.iloc[[gps_point_idx]]["latitude"].item())
-                    gps_point_idx += 1
-                    continue
+            points = response_data["paths"][0]["points"]["coordinates"]
             
-                snapped_to_segment = snap(
-                    gps_data.iloc[[gps_point_idx]]["longitude"].item(),
-                    gps_data.iloc[[gps_point_idx]]["latitude"].item(),
-                    segment[0][0],
-                    segment[0][1],
-                    segment[1][0],
-                    segment[1][1],
-                )
-                distance_to_segment = haversine_distance(
-                    gps_data.iloc[[gps_point_idx]]["longitude"].item(),
-                    gps_data.iloc[[gps_point_idx]]["latitude"].item(),
-                    snapped_to_segment[0],
-                    snapped_to_segment[1],
-                )
-                snapped_to_next_segment = snap(
-                    gps_data.iloc[[gps_point_idx]]["longitude"].item(),
-                    gps_data.iloc[[gps_point_idx]]["latitude"].item(),
-                    next_segment[0][0],
-                    next_segment[0][1],
-                    next_segment[1][0],
-                    next_segment[1][1],
-                )
-                distance_to_next_segment = haversine_distance(
-                    gps_data.iloc[[gps_point_idx]]["longitude"].item(),
-                    gps_data.iloc[[gps_point_idx]]["latitude"].item(),
-                    snapped_to_next_segment[0],
-                    snapped_to_next_segment[1],
-                )
-               
-                if distance_to_segment < distance_to_next_segment:
-                    speeds_on_segment.append(gps_data.iloc[[gps_point_idx]]["speed"].item())
-                    data_exchange_debugger.add_snapping_line(segment, gps_data.iloc[[gps_point_idx]]["longitude"].item(), gps_data.iloc[[gps_point_idx]]["latitude"].item())
-                    gps_point_idx += 1
-                else:
-                    gpx_point_on_segment = False
-                
-            if len(speeds_on_segment) == 0:
-                raise ValueError("Expected at least one snapped point on the line")
+            if track_debugger is not None:
+                track_debugger.add_map_matched_points(points)
             
-            output.add_processed_segment(segment, bike_type, speeds_on_segment)
-        
-        data_exchange_debugger.write_geojson(track_idx)
-        track_idx += 1
+            metrics.increment("tracks_processed")
+            metrics.increment("gps_points_processed", len(track))
+            metrics.increment(f"matched_segments_{mode}", max(len(points) - 1, 0))
+            yield track_idx, track, points, track_debugger
+            track_idx += 1
+    
+    if workers == 1:
+        for _, track, points, track_debugger in tracks_to_snap():
+            with metrics.time("snapping"):
+                snapped_segment_count = snap_to_segments(output, track, points, track_debugger)
+            metrics.increment(f"snapped_segments_{mode}", snapped_segment_count)
+            data_exchange_debugger.finish_track(track_debugger)
+            checkpointer.complete(track.pk)
+            checkpointer.save_if_due()
+    else:
+        # Shard the tracks in batches across the worker processes. Every batch is snapped
+        # into its own output, the outputs are merged in track order, which gives the same
+        # result as snapping all tracks in this process.
+        snapping_seconds = 0.0
+        snapping_start = time.perf_counter()
+        # The fetch and map matching threads are already running, forking them could copy held locks
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("forkserver")) as snapping_executor:
+            batch_outputs = ordered_map(
+                snapping_executor,
+                partial(snap_batch, create_speed_aggregate),
+                batched(tracks_to_snap(), SNAPPING_BATCH_SIZE),
+                max_pending=2 * workers,
+            )
+            for batch_output, batch_pks, snapped_segment_count, batch_seconds in batch_outputs:
+                output.merge(batch_output)
+                metrics.increment(f"snapped_segments_{mode}", snapped_segment_count)
+                snapping_seconds += batch_seconds
+                metrics.observe("snapping_batch", batch_seconds)
+                for pk in batch_pks:
+                    checkpointer.complete(pk)
+                checkpointer.save_if_due()
+        wall_seconds = time.perf_counter() - snapping_start
+        print(f"Snapped tracks for {snapping_seconds:.1f} s on {workers} workers within {wall_seconds:.1f} s (speedup {snapping_seconds / wall_seconds:.1f}x)")
     
+    map_matching_executor.shutdown()
+    map_matcher.close()
+    data_exchange_debugger.close()
     output.print_meta_stats()
+    if simplifier is not None:
+        simplifier.print_stats()
+    map_matcher.print_stats()
+    print_matching_stats(mode)
+    
+    # The last upserts into a segment store are only committed with a checkpoint, which now contains all tracks
+    if output.store is not None:
+        output.flush()
+        checkpointer.save()
         
     return output.get_processed_segments()
         
-def anonymize_segments(segments):
+def get_segment_store_path(segment_store_dir, start_time, end_time):
+    return os.path.join(segment_store_dir, f'{start_time}_{end_time}.sqlite')
+
+def segment_tables(segments):
+    # A segment store is streamed in tables of its batch size
+    if isinstance(segments, SqliteSegmentStore):
+        return segments.tables()
+    return [segments]
+
+def load_segments(segments):
+    # For the stages that need all segments at once
+    if isinstance(segments, SqliteSegmentStore):
+        return segments.load()
+    return segments
+
+def remove_segment_stores(*segments):
+    for store in segments:
+        if isinstance(store, SqliteSegmentStore):
+            store.remove()
+
+def anonymous_segments(segments):
     # Anonymization Rules:
     # Delete first and last segment of every track (happens in the previous step (process_segments() already))
     # Delete all segments with a total count of 1
     # Delete all segments with with only one bike type
     
-    anonymized_segments = {}
+    processed = segments.total_counts > 0
+    anonymous = (segments.total_counts > 1) & (np.count_nonzero(segments.profile_counts, axis=1) > 1)
+    return processed, anonymous
+
+@metrics.timed("anonymize")
+def anonymize_segments(segments):
     removed_segments = 0
-    for segment in segments:
-        if segments[segment]["total_count"] > 1 and len(segments[segment]["profiles"]) > 1:
-            anonymized_segments[segment] = segments[segment]
-        else:
-            removed_segments += 1
+    if isinstance(segments, SqliteSegmentStore):
+        # Every segment is anonymized on its own, so the store is anonymized table by table
+        def anonymous_ids(table):
+            nonlocal removed_segments
+            processed, anonymous = anonymous_segments(table)
+            removed_segments += np.count_nonzero(processed & ~anonymous)
+            return np.flatnonzero(anonymous)
+        anonymized_segments = segments.filtered(anonymous_ids, f'{os.path.splitext(segments.path)[0]}.anonymized.sqlite')
+    else:
+        processed, anonymous = anonymous_segments(segments)
+        anonymized_segments = segments.subset(np.flatnonzero(anonymous))
+        removed_segments = np.count_nonzero(processed & ~anonymous)
             
     print(f"Number of removed segments: {removed_segments}")
     print(f"Number of anonymous segments: {len(anonymized_segments)}")
     
     return anonymized_segments
 
-def create_geojson_output(segments, start_time, end_time):
-    geojson = {
-        "type": "FeatureCollection",
-        "properties": {
-            "start_time": start_time,
-            "end_time": end_time,
-        },
-        "features": []
+def get_history_polylines_path(start_time, end_time):
+    return f'static/history_polylines/{start_time}_{end_time}.json'
+
+def get_report_path(start_time, end_time):
+    # Outside of static/, which is published as it is
+    return f'reports/{start_time}_{end_time}.report.json'
+
+def write_run_report(report_path, prometheus_textfile, elapsed_seconds=None, **properties):
+    if report_path:
+        metrics.write_report(report_path, elapsed_seconds=elapsed_seconds, **properties)
+    if prometheus_textfile:
+        metrics.write_prometheus(prometheus_textfile, elapsed_seconds=elapsed_seconds)
+
+def get_packed_path(path):
+    return f'{os.path.splitext(path)[0]}.bin'
+
+def create_geojson_properties(segments, segment_id):
+    total_count = int(segments.total_counts[segment_id])
+    total_speeds = segments.total_speeds[segment_id]
+    
+    properties = {
+        "total_count": total_count,
+        "total_median_speed_ms": total_speeds.median(),
+        "total_p15_speed_ms": total_speeds.percentile(15),
+        "total_p85_speed_ms": total_speeds.percentile(85),
+        "profiles": {},
     }
+    
+    for profile_key, profile_meta in segments.profiles(segment_id).items():
+        profile_count = profile_meta['count']
+        profile_speeds = profile_meta['speeds']
         
-    for segment_key, segment_meta in segments.items():
-        coordinates = segment_key.split('_')
-        start_lng = float(coordinates[0])
-        start_lat = float(coordinates[1])
-        end_lng = float(coordinates[2])
-        end_lat = float(coordinates[3])
-        
-        total_count = segment_meta['total_count']
-        total_median_speed = np.median(segment_meta['total_speeds'])
-        
-        properties = {
-            "total_count": total_count,
-            "total_median_speed_ms": total_median_speed,
-            "profiles": {},
+        properties['profiles'][profile_key] = {
+            "count": profile_count,
+            "median_speed_ms": profile_speeds.median(),
+            "p15_speed_ms": profile_speeds.percentile(15),
+            "p85_speed_ms": profile_speeds.percentile(85),
         }
         
-        for profile_key, profile_meta in segment_meta['profiles'].items():
-            profile_count = profile_meta['count']
-            profile_median_speed = np.median(profile_meta['speeds'])
-            
-            properties['profiles'][profile_key] = {
-                "count": profile_count,
-                "median_speed_ms": profile_median_speed,
-            }
-            
-        feature = {
-            "type": "Feature",
-            "geometry": {
-                "type": "LineString",
-                "coordinates": [
-                    [start_lng, start_lat],
-                    [end_lng, end_lat],
-                ],
-            },
-            "properties": properties,
-        }
+    return properties
+
+def create_geojson_feature(segments, segment_ids, properties, coordinate_precision=7):
+    # A feature is a single segment or a stitched chain of segments
+    (start_lng, start_lat), _ = segments.segment(segment_ids[0])
+    coordinates = [[round(start_lng, coordinate_precision), round(start_lat, coordinate_precision)]]
+    for segment_id in segment_ids:
+        _, (end_lng, end_lat) = segments.segment(segment_id)
+        coordinates.append([round(end_lng, coordinate_precision), round(end_lat, coordinate_precision)])
+    return {
+        "type": "Feature",
+        "geometry": {
+            "type": "LineString",
+            "coordinates": coordinates,
+        },
+        "properties": properties,
+    }
+
+@metrics.timed("geojson_output")
+def create_geojson_output(segments, start_time, end_time, path=None, stitch_speed_tolerance=None, coordinate_precision=7, compress=True, packed=False):
+    if path is None:
+        path = get_history_polylines_path(start_time, end_time)
+    packed_path = get_packed_path(path) if packed else None
+    
+    # Without stitching, every feature is only created when it is written and a segment store is streamed
+    if stitch_speed_tolerance is None:
+        features = (
+            create_geojson_feature(table, [segment_id], create_geojson_properties(table, segment_id), coordinate_precision=coordinate_precision)
+            for table in segment_tables(segments)
+            for segment_id in table.processed_ids().tolist()
+        )
+    else:
+        # Chains can span the whole window, so stitching needs all segments in memory
+        segments = load_segments(segments)
+        segment_ids = segments.processed_ids().tolist()
+        properties = {segment_id: create_geojson_properties(segments, segment_id) for segment_id in segment_ids}
+        unstitched_size = sum(len(json.dumps(create_geojson_feature(segments, [segment_id], properties[segment_id], coordinate_precision=coordinate_precision))) for segment_id in segment_ids) + 2 * max(len(segment_ids) - 1, 0)
+        # The chain gets the properties of its first segment, the others are within the speed tolerance
+        chains = stitch_segments(segments, segment_ids, properties, stitch_speed_tolerance)
+        features = (create_geojson_feature(segments, chain, properties[chain[0]], coordinate_precision=coordinate_precision) for chain in chains)
+    
+    with FeatureCollectionWriter(path, {"start_time": start_time, "end_time": end_time}, compress=compress, packed_path=packed_path) as writer:
+        for feature in features:
+            writer.write(feature)
+    
+    if stitch_speed_tolerance is not None:
+        print(f"Stitched {len(segment_ids)} segments into {writer.feature_count} polylines, {writer.features_size / 1000:.1f} kB of features instead of {unstitched_size / 1000:.1f} kB ({100 * (1 - writer.features_size / max(unstitched_size, 1)):.1f}% smaller)")
+    sizes = [f"{writer.size / 1000:.1f} kB GeoJSON"]
+    if compress:
+        sizes.append(f"{os.path.getsize(f'{path}.gz') / 1000:.1f} kB gzip")
+        if os.path.exists(f'{path}.br'):
+            sizes.append(f"{os.path.getsize(f'{path}.br') / 1000:.1f} kB brotli")
+    if packed:
+        sizes.append(f"{os.path.getsize(packed_path) / 1000:.1f} kB packed")
+    print(f"Wrote {path}: {', '.join(sizes)}")
         
-        geojson['features'].append(feature)
+def get_tiles_path(start_time, end_time):
+    return f'static/tiles/{start_time}_{end_time}'
         
-    with open(f'static/history_polylines/{start_time}_{end_time}.json', 'w') as f:
-        json.dump(geojson, f)
+@metrics.timed("tiled_output")
+def create_tiled_output(segments, start_time, end_time, zoom_levels, stitch_speed_tolerance=None, coordinate_precision=7, compress=True, packed=False):
+    # Every zoom level gets its own z/x/y directory of GeoJSON tiles, the
+    # manifest lists the tiles that exist so clients only request those.
+    tiles_path = get_tiles_path(start_time, end_time)
+    segments = load_segments(segments)
+    segment_ids = segments.processed_ids()
+    properties = {segment_id: create_geojson_properties(segments, segment_id) for segment_id in segment_ids.tolist()}
+    manifest = {
+        "start_time": start_time,
+        "end_time": end_time,
+        "zoom_levels": list(zoom_levels),
+        "packed": packed,
+        "tiles": {},
+    }
+    for zoom in zoom_levels:
+        manifest["tiles"][str(zoom)] = []
+        for (x, y), tile_segment_ids in tile_segments(segments, segment_ids, zoom).items():
+            if stitch_speed_tolerance is None:
+                chains = [[segment_id] for segment_id in tile_segment_ids.tolist()]
+            else:
+                # Chains are stitched per tile, a chain that crosses the tile border is split there
+                chains = stitch_segments(segments, tile_segment_ids, properties, stitch_speed_tolerance)
+            os.makedirs(f'{tiles_path}/{zoom}/{x}', exist_ok=True)
+            tile_path = f'{tiles_path}/{zoom}/{x}/{y}.json'
+            tile_properties = {"start_time": start_time, "end_time": end_time, "tile": [zoom, x, y]}
+            with FeatureCollectionWriter(tile_path, tile_properties, compress=compress, packed_path=get_packed_path(tile_path) if packed else None) as writer:
+                for chain in chains:
+                    writer.write(create_geojson_feature(segments, chain, properties[chain[0]], coordinate_precision=coordinate_precision))
+            manifest["tiles"][str(zoom)].append([x, y, writer.feature_count])
+        print(f"Wrote {len(manifest['tiles'][str(zoom)])} tiles at zoom level {zoom}")
+    
+    with open(f'{tiles_path}/manifest.json', 'w') as f:
+        json.dump(manifest, f)
         
-def update_index(start_time, end_time):
+def update_index(buckets):
     index_path = 'static/index.json'
     with open(index_path, 'r') as f:
         index = json.load(f)
-    index["files"].append({
-        "start_time": start_time,
-        "end_time": end_time,
-        "path": f"history_polylines/{start_time}_{end_time}.geojson",
-    })
+    indexed_buckets = {(file["start_time"], file["end_time"]) for file in index["files"]}
+    for start_time, end_time in buckets:
+        if (start_time, end_time) in indexed_buckets:
+            continue
+        index["files"].append({
+            "start_time": start_time,
+            "end_time": end_time,
+            "path": f"history_polylines/{start_time}_{end_time}.geojson",
+        })
+    for file in index["files"]:
+        if os.path.exists(get_packed_path(get_history_polylines_path(file["start_time"], file["end_time"]))):
+            file["packed"] = f'history_polylines/{file["start_time"]}_{file["end_time"]}.bin'
+    # The tile manifest is referenced from the bucket as soon as it was written
+    for file in index["files"]:
+        if os.path.exists(f'{get_tiles_path(file["start_time"], file["end_time"])}/manifest.json'):
+            file["tiles"] = f'tiles/{file["start_time"]}_{file["end_time"]}/manifest.json'
+    index["files"].sort(key=lambda file: file["start_time"])
     index["total_count"] = len(index["files"])
     with open(index_path, 'w') as f:
         json.dump(index, f)
+        
+@metrics.timed("layers")
+def update_layers(aggregate_store, output_options):
+    layers = aggregate_store.update_layers()
+    os.makedirs('static/layers', exist_ok=True)
+    for name, (segments, start_time, end_time) in layers.items():
+        print(f"Anonymizing layer {name}...")
+        anonymized_segments = anonymize_segments(segments)
+        create_geojson_output(anonymized_segments, start_time, end_time, path=f'static/layers/{name}.json', **output_options)
+        # The layer stores are kept in the aggregates directory, only their anonymized copies are removed
+        remove_segment_stores(anonymized_segments)
+        if isinstance(segments, SqliteSegmentStore):
+            segments.close()
+    
+    index_path = 'static/index.json'
+    with open(index_path, 'r') as f:
+        index = json.load(f)
+    index["layers"] = [
+        {
+            "name": name,
+            "start_time": start_time,
+            "end_time": end_time,
+            "path": f"layers/{name}.json",
+            **({"packed": f"layers/{name}.bin"} if output_options.get("packed") else {}),
+        }
+        for name, (_, start_time, end_time) in layers.items()
+    ]
+    with open(index_path, 'w') as f:
+        json.dump(index, f)
+        
+def backfill(tracking_service_url, tracking_service_api_key, graphhopper_service_url, from_time, to_time, bucket_size, parallel_buckets=4, write_output=False, aggregate_store=None, tile_zoom_levels=(), output_options=None, **processing_options):
+    if output_options is None:
+        output_options = {}
+    
+    # Buckets with an existing output file are skipped, they may only be missing in the index
+    buckets = split_into_buckets(from_time, to_time, bucket_size)
+    missing_buckets = [bucket for bucket in buckets if not os.path.exists(get_history_polylines_path(*bucket))]
+    print(f"Backfilling {len(missing_buckets)} of {len(buckets)} buckets, {len(buckets) - len(missing_buckets)} already exist")
+    
+    def process_bucket(bucket):
+        start_time, end_time = bucket
+        print(f"Processing bucket {start_time}_{end_time}...")
+        processed_segments = process_segments(tracking_service_url, tracking_service_api_key, graphhopper_service_url, start_time, end_time, **processing_options)
+        anonymized_segments = anonymize_segments(processed_segments)
+        if write_output:
+            create_geojson_output(anonymized_segments, start_time, end_time, **output_options)
+            if tile_zoom_levels:
+                create_tiled_output(anonymized_segments, start_time, end_time, tile_zoom_levels, **output_options)
+            if aggregate_store is not None:
+                aggregate_store.save_bucket(processed_segments, start_time, end_time)
+        remove_segment_stores(processed_segments, anonymized_segments)
+        print(f"Finished bucket {start_time}_{end_time}")
     
-def main(tracking_service_url, tracking_service_api_key, graphhopper_service_url, write_output=False, debug=False):
-    start_time = get_time_of_last_bucket()
-    end_time = current_milli_time()
+    # Every bucket is fetched and map matched independently
+    with ThreadPoolExecutor(max_workers=parallel_buckets) as executor:
+        for _ in executor.map(process_bucket, missing_buckets):
+            pass
+    
+    if write_output:
+        update_index([bucket for bucket in buckets if os.path.exists(get_history_polylines_path(*bucket))])
+        if aggregate_store is not None:
+            update_layers(aggregate_store, output_options)
+    
+def main(tracking_service_url, tracking_service_api_key, graphhopper_service_url, write_output=False, debug=False, debug_sample_every=1, debug_sample_pks=None, debug_batch_size=100, fetch_workers=8, queue_size=32, map_matching_workers=16, map_matching_cache_dir=None, map_matching_cache_size_mb=1024, map_matching_timestamps=False, simplify_distance=None, simplify_tolerance=None, speed_aggregate="histogram", speed_bin_width=0.25, workers=1, segment_store_dir=None, segment_store_batch_size=50000, state_dir=None, checkpoint_interval=300, resume=False, backfill_range=None, bucket_size=None, parallel_buckets=4, aggregates_dir=None, tile_zoom_levels=(), stitch_speed_tolerance=None, coordinate_precision=7, compress=True, packed=False, report_path=None, prometheus_textfile=None):
+    map_matching_cache = None
+    if map_matching_cache_dir:
+        map_matching_cache = MapMatchingCache(map_matching_cache_dir, max_size_bytes=map_matching_cache_size_mb * 1024 * 1024)
+    
+    processing_options = {
+        "fetch_workers": fetch_workers,
+        "queue_size": queue_size,
+        "map_matching_workers": map_matching_workers,
+        "map_matching_cache": map_matching_cache,
+        "map_matching_timestamps": map_matching_timestamps,
+        "simplify_distance": simplify_distance,
+        "simplify_tolerance": simplify_tolerance,
+        "create_speed_aggregate": speed_aggregate_factory(speed_aggregate, bin_width=speed_bin_width),
+        "workers": workers,
+        "segment_store_dir": segment_store_dir,
+        "segment_store_batch_size": segment_store_batch_size,
+    }
+    
+    output_options = {
+        "stitch_speed_tolerance": stitch_speed_tolerance,
+        "coordinate_precision": coordinate_precision,
+        "compress": compress,
+        "packed": packed,
+    }
+    aggregate_store = AggregateStore(aggregates_dir, create_speed_aggregate=processing_options["create_speed_aggregate"], batch_size=segment_store_batch_size) if aggregates_dir else None
     
-    processed_segments = process_segments(tracking_service_url, tracking_service_api_key, graphhopper_service_url, start_time, end_time, use_debugging=debug)
+    if backfill_range is not None:
+        from_time, to_time = backfill_range
+        # The buckets are processed in parallel, so the throughput is measured over the whole backfill
+        backfill_start = time.perf_counter()
+        backfill(tracking_service_url, tracking_service_api_key, graphhopper_service_url, from_time, to_time, bucket_size, parallel_buckets=parallel_buckets, write_output=write_output, aggregate_store=aggregate_store, tile_zoom_levels=tile_zoom_levels, output_options=output_options, **processing_options)
+        if report_path is None and write_output:
+            report_path = get_report_path(f"backfill_{from_time}", to_time)
+        write_run_report(report_path, prometheus_textfile, elapsed_seconds=time.perf_counter() - backfill_start, start_time=from_time, end_time=to_time, backfill=True)
+        return
+    
+    checkpointer = Checkpointer(state_dir, interval_seconds=checkpoint_interval)
+    if resume and checkpointer.load():
+        start_time = checkpointer.start_time
+        end_time = checkpointer.end_time
+        print(f"Resuming from checkpoint with {len(checkpointer.completed_pks)} completed tracks")
+    else:
+        if resume:
+            print("No checkpoint found, starting a new run")
+        start_time = get_time_of_last_bucket()
+        end_time = current_milli_time()
+    
+    processed_segments = process_segments(tracking_service_url, tracking_service_api_key, graphhopper_service_url, start_time, end_time, use_debugging=debug, debug_sample_every=debug_sample_every, debug_sample_pks=debug_sample_pks, debug_batch_size=debug_batch_size, checkpointer=checkpointer, **processing_options)
     if debug:
         with open("processed_segments.json", "w") as f:
-            json.dump(processed_segments, f)
+            json.dump(load_segments(processed_segments).to_json(), f)
     anonymized_segments = anonymize_segments(processed_segments)
     if debug:
         with open("anonymized_segments.json", "w") as f:
-            json.dump(anonymized_segments, f)
+            json.dump(load_segments(anonymized_segments).to_json(), f)
     if write_output:
-        create_geojson_output(anonymized_segments, start_time, end_time)
-        update_index(start_time, end_time)
+        create_geojson_output(anonymized_segments, start_time, end_time, **output_options)
+        if tile_zoom_levels:
+            create_tiled_output(anonymized_segments, start_time, end_time, tile_zoom_levels, **output_options)
+        update_index([(start_time, end_time)])
+        if aggregate_store is not None:
+            aggregate_store.save_bucket(processed_segments, start_time, end_time)
+            update_layers(aggregate_store, output_options)
+    remove_segment_stores(processed_segments, anonymized_segments)
+    checkpointer.clear()
+    
+    if report_path is None and write_output:
+        report_path = get_report_path(start_time, end_time)
+    write_run_report(report_path, prometheus_textfile, start_time=start_time, end_time=end_time, backfill=False)
 
 if __name__ == "__main__":
     parser=argparse.ArgumentParser()
 
     parser.add_argument("--output", help="Write the anonymized geojson output to a file. Default: False. If False, the script will perform a dry run and only print meta information about the theoretical output.")
     parser.add_argument("--debug", help="Create debug geojson files about the map matching and snapping. Default: False.")
+    parser.add_argument("--debug-sample-every", type=int, default=1, help="Only debug every n-th track. Default: 1.")
+    parser.add_argument("--debug-pks", default="", help="Comma separated pks of the tracks to debug, instead of sampling every n-th track.")
+    parser.add_argument("--debug-batch-size", type=int, default=100, help="Number of debugged tracks per debug geojson file. Default: 100.")
+    parser.add_argument("--fetch-workers", type=int, default=8, help="Number of tracks that are fetched concurrently from the tracking service. Default: 8.")
+    parser.add_argument("--queue-size", type=int, default=32, help="Maximum number of tracks that are buffered between the fetching, map matching and snapping stages. Default: 32.")
+    parser.add_argument("--map-matching-workers", type=int, default=16, help="Maximum number of concurrent map matching requests to GraphHopper. The actual number adapts to the response times and errors. Default: 16.")
+    parser.add_argument("--map-matching-cache", default=".cache/map_matching", help="Directory of the persistent map matching cache. The default is inside the checkout, which CI cleans before every run, pass a path outside of it to keep the cache between CI runs. Pass an empty string to disable the cache. Default: .cache/map_matching.")
+    parser.add_argument("--map-matching-cache-size-mb", type=int, default=1024, help="Maximum size of the map matching cache in MB, the least recently used responses are evicted first. Default: 1024.")
+    parser.add_argument("--map-matching-timestamps", default="False", help="Include the GPS timestamps in the map matching requests, if the tracks have them (True/False). Default: False.")
+    parser.add_argument("--simplify", default="False", help="Drop stationary points and simplify the tracks with Douglas-Peucker before map matching, the speeds are still taken from all points (True/False). Default: False.")
+    parser.add_argument("--simplify-distance", type=float, default=3.0, help="Points within this distance in meters of the previous point are dropped as stationary. Default: 3.")
+    parser.add_argument("--simplify-tolerance", type=float, default=5.0, help="Douglas-Peucker tolerance in meters. Default: 5.")
+    parser.add_argument("--speed-aggregate", default="histogram", choices=["histogram", "exact"], help="How the speeds of a segment are aggregated. \"histogram\" needs constant memory per segment, \"exact\" keeps every speed sample for validation. Default: histogram.")
+    parser.add_argument("--speed-bin-width", type=float, default=0.25, help="Width of the speed histogram bins in m/s, the percentiles are accurate within half a bin width. Default: 0.25.")
+    parser.add_argument("--workers", type=int, default=1, help="Number of processes that snap the tracks to the map matched segments. Default: 1.")
+    parser.add_argument("--segment-store", default="", help="Directory for on-disk SQLite stores of the segment aggregates, so the memory stays bounded for large time windows. The segments are upserted in batches during processing, anonymized and written table by table, only stitching and tiles load the anonymized segments into memory. Pass an empty string to aggregate in memory. Default: in memory.")
+    parser.add_argument("--segment-store-batch-size", type=int, default=50000, help="Number of segments that are aggregated in memory before they are upserted into the segment store, and that are read from it at once. Default: 50000.")
+    parser.add_argument("--state-dir", default=".state", help="Directory for the checkpoints of the run. The default is inside the checkout, which CI cleans before every run, pass a path outside of it to resume interrupted CI runs. Pass an empty string to disable checkpoints. Default: .state.")
+    parser.add_argument("--checkpoint-interval", type=int, default=300, help="Seconds between two checkpoints. Default: 300.")
+    parser.add_argument("--resume", help="Resume the time window of the last interrupted run from its checkpoint. Default: False.")
+    parser.add_argument("--backfill", help="Process the time range --from to --to in buckets of --bucket-size instead of the time since the last bucket. Buckets with existing output are skipped. Default: False.")
+    parser.add_argument("--from", dest="from_time", help="Start of the backfill range, as timestamp in milliseconds or ISO 8601 date (UTC).")
+    parser.add_argument("--to", dest="to_time", help="End of the backfill range, as timestamp in milliseconds or ISO 8601 date (UTC). Default: now.")
+    parser.add_argument("--bucket-size", default="1d", help="Size of the backfill buckets, e.g. 12h, 1d or 1w. Default: 1d.")
+    parser.add_argument("--parallel-buckets", type=int, default=4, help="Number of backfill buckets that are processed concurrently. Default: 4.")
+    parser.add_argument("--tile-zoom-levels", default="", help="Comma separated zoom levels, e.g. 12,14, at which every bucket is additionally written as z/x/y GeoJSON tiles with a tile manifest. Default: no tiles.")
+    parser.add_argument("--stitch", default="False", help="Stitch chains of adjacent segments with equal counts and similar speeds into one polyline (True/False). Default: False.")
+    parser.add_argument("--stitch-speed-tolerance", type=float, default=0.5, help="Maximum difference of the speeds of stitched segments in m/s. Default: 0.5.")
+    parser.add_argument("--coordinate-precision", type=int, default=7, help="Number of decimals of the written coordinates. Default: 7, which keeps the full precision of the segments.")
+    parser.add_argument("--compress", default="True", help="Write .gz and, if the brotli package is installed, .br siblings of every output file for nginx gzip_static and brotli_static (True/False). Default: True.")
+    parser.add_argument("--packed-output", default="False", help="Additionally write every output file in a packed columnar binary encoding as .bin, see lib/writer.py (True/False). Default: False.")
+    parser.add_argument("--report", default=None, help="Path of the JSON run report with the timings, latency histograms, throughput and peak memory of every stage. Default: reports/<start>_<end>.report.json if --output is True.")
+    parser.add_argument("--prometheus-textfile", default=None, help="Path of a Prometheus textfile (e.g. for the node exporter textfile collector) to write the run metrics to. Default: none.")
+    parser.add_argument("--aggregates-dir", default="", help="Private directory for the non-anonymized segment aggregates of every bucket, from which the daily, weekly, monthly and all time layers are rolled up. Must be kept between runs, so it should be outside of the checkout, which CI cleans before every run. Must not be published. Default: no layers.")
 
     args=parser.parse_args()
     
@@ -279,6 +635,43 @@ if __name__ == "__main__":
     if args.debug and args.debug.lower() == "true":
         debug = True
         
+    debug_sample_pks = [int(pk) for pk in args.debug_pks.split(",") if pk.strip()]
+        
+    resume = False
+    if args.resume and args.resume.lower() == "true":
+        resume = True
+        
+    backfill_range = None
+    if args.backfill and args.backfill.lower() == "true":
+        if not args.from_time:
+            raise ValueError("Please set --from for the backfill")
+        to_time = parse_time(args.to_time) if args.to_time else current_milli_time()
+        backfill_range = (parse_time(args.from_time), to_time)
+        
+    stitch_speed_tolerance = None
+    if args.stitch and args.stitch.lower() == "true":
+        stitch_speed_tolerance = args.stitch_speed_tolerance
+        
+    map_matching_timestamps = False
+    if args.map_matching_timestamps and args.map_matching_timestamps.lower() == "true":
+        map_matching_timestamps = True
+        
+    simplify_distance = None
+    simplify_tolerance = None
+    if args.simplify and args.simplify.lower() == "true":
+        simplify_distance = args.simplify_distance
+        simplify_tolerance = args.simplify_tolerance
+        
+    compress = False
+    if args.compress and args.compress.lower() == "true":
+        compress = True
+        
+    packed = False
+    if args.packed_output and args.packed_output.lower() == "true":
+        packed = True
+        
+    tile_zoom_levels = [int(zoom) for zoom in args.tile_zoom_levels.split(",") if zoom.strip()]
+        
     tracking_service_url = os.environ["TRACKING_SERVICE_URL"]
     tracking_service_api_key = os.environ["TRACKING_SERVICE_API_KEY"]
     graphhopper_service_url = os.environ["GRAPHHOPPER_SERVICE_URL"]
@@ -293,5 +686,27 @@ if __name__ == "__main__":
     print(f"GraphHopper service URL: {graphhopper_service_url}")
     print(f"Write anonymized geojson output: {write_output}")
     print(f"Write debug map matching and snapping geojson output: {debug}")
+    if debug:
+        print(f"Debug sampling: {f'pks {args.debug_pks}' if debug_sample_pks else f'every {args.debug_sample_every}. track'}, {args.debug_batch_size} tracks per file")
+    print(f"Fetch workers: {args.fetch_workers}")
+    print(f"Queue size: {args.queue_size}")
+    print(f"Map matching workers: {args.map_matching_workers}")
+    print(f"Map matching cache: {args.map_matching_cache or 'disabled'}")
+    print(f"Map matching timestamps: {map_matching_timestamps}")
+    print(f"Simplify tracks: {'disabled' if simplify_tolerance is None else f'{simplify_distance} m stationary distance, {simplify_tolerance} m tolerance'}")
+    print(f"Speed aggregate: {args.speed_aggregate}")
+    print(f"Workers: {args.workers}")
+    print(f"Segment store: {f'{args.segment_store} in batches of {args.segment_store_batch_size} segments' if args.segment_store else 'in memory'}")
+    print(f"Resume from checkpoint: {resume}")
+    print(f"Aggregate layers: {args.aggregates_dir or 'disabled'}")
+    print(f"Stitch speed tolerance: {'disabled' if stitch_speed_tolerance is None else f'{stitch_speed_tolerance} m/s'}")
+    print(f"Coordinate precision: {args.coordinate_precision} decimals")
+    print(f"Compressed output: {compress}")
+    if compress and not BROTLI_AVAILABLE:
+        print("Warning: the brotli package is not installed, only .gz and no .br files are written. Install the requirements.txt to write both.")
+    print(f"Packed output: {packed}")
+    print(f"Tile zoom levels: {', '.join(str(zoom) for zoom in tile_zoom_levels) or 'disabled'}")
+    if backfill_range is not None:
+        print(f"Backfill: {backfill_range[0]} to {backfill_range[1]} in buckets of {args.bucket_size}")
     
-    main(tracking_service_url, tracking_service_api_key, graphhopper_service_url, write_output=write_output, debug=debug)
\ No newline at end of file
+    main(tracking_service_url, tracking_service_api_key, graphhopper_service_url, write_output=write_output, debug=debug, debug_sample_every=args.debug_sample_every, debug_sample_pks=debug_sample_pks, debug_batch_size=args.debug_batch_size, fetch_workers=args.fetch_workers, queue_size=args.queue_size, map_matching_workers=args.map_matching_workers, map_matching_cache_dir=args.map_matching_cache, map_matching_cache_size_mb=args.map_matching_cache_size_mb, map_matching_timestamps=map_matching_timestamps, simplify_distance=simplify_distance, simplify_tolerance=simplify_tolerance, speed_aggregate=args.speed_aggregate, speed_bin_width=args.speed_bin_width, workers=args.workers, segment_store_dir=args.segment_store or None, segment_store_batch_size=args.segment_store_batch_size, state_dir=args.state_dir or None, checkpoint_interval=args.checkpoint_interval, resume=resume, backfill_range=backfill_range, bucket_size=parse_duration(args.bucket_size), parallel_buckets=args.parallel_buckets, aggregates_dir=args.aggregates_dir, tile_zoom_levels=tile_zoom_levels, stitch_speed_tolerance=stitch_speed_tolerance, coordinate_precision=args.coordinate_precision, compress=compress, packed=packed, report_path=args.report, prometheus_textfile=args.prometheus_textfile)
\ No newline at end of file
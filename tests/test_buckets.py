@@ -0,0 +1,42 @@
+import pytest
+from lib.buckets import DURATION_UNITS_MS, parse_duration, parse_time, split_into_buckets
+
+@pytest.mark.parametrize("value", [
+    "1704067200000",
+    "2024-01-01",
+    "2024-01-01T00:00:00",
+    "2024-01-01T00:00:00Z",
+    "2024-01-01T00:00:00.000Z",
+    "2024-01-01T01:00:00+01:00",
+])
+def test_parse_time(value):
+    assert parse_time(value) == 1704067200000
+
+def test_parse_invalid_time():
+    with pytest.raises(ValueError):
+        parse_time("yesterday")
+
+@pytest.mark.parametrize("value, milliseconds", [
+    ("30m", 30 * 60 * 1000),
+    ("12h", 12 * 60 * 60 * 1000),
+    ("1d", 24 * 60 * 60 * 1000),
+    ("2w", 14 * 24 * 60 * 60 * 1000),
+])
+def test_parse_duration(value, milliseconds):
+    assert parse_duration(value) == milliseconds
+
+@pytest.mark.parametrize("value", ["", "1", "d", "1.5d", "-1d", "1y"])
+def test_parse_invalid_duration(value):
+    with pytest.raises(ValueError):
+        parse_duration(value)
+
+def test_split_into_buckets():
+    day = DURATION_UNITS_MS["d"]
+    assert split_into_buckets(0, 3 * day, day) == [(0, day), (day, 2 * day), (2 * day, 3 * day)]
+    # The last bucket ends at the end of the range
+    assert split_into_buckets(0, 2 * day + 5, day) == [(0, day), (day, 2 * day), (2 * day, 2 * day + 5)]
+    assert split_into_buckets(day, day, day) == []
+
+def test_split_into_buckets_needs_a_positive_size():
+    with pytest.raises(ValueError):
+        split_into_buckets(0, 1, 0)
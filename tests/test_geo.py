@@ -0,0 +1,99 @@
+import numpy as np
+import pytest
+from lib.geo import haversine_distance, snap, snap_track
+
+def snap_track_scalar(points, longitudes, latitudes, speeds):
+    """
+    The original greedy loop of process_segments with snap and
+    haversine_distance, as reference for snap_track.
+    """
+    snapped_segments = []
+    gps_point_idx = 0
+    gps_point_count = len(longitudes)
+    for point_idx in range(len(points) - 1):
+        # Anonyimze by skipping the first and last segment
+        if point_idx == 0 or point_idx >= len(points) - 2:
+            continue
+        segment = (
+            (points[point_idx][0], points[point_idx][1]),
+            (points[point_idx + 1][0], points[point_idx + 1][1]),
+        )
+        if gps_point_idx >= gps_point_count:
+            snapped_segments.append((segment, [], []))
+            continue
+        if point_idx < len(points) - 2:
+            next_segment = (segment[1], (points[point_idx + 2][0], points[point_idx + 2][1]))
+        else:
+            next_segment = None
+        
+        first_gps_point_idx = gps_point_idx
+        gps_point_idx += 1
+        while gps_point_idx < gps_point_count - 2:
+            if next_segment is None:
+                gps_point_idx += 1
+                continue
+            lng, lat = float(longitudes[gps_point_idx]), float(latitudes[gps_point_idx])
+            snapped_to_segment = snap(lng, lat, segment[0][0], segment[0][1], segment[1][0], segment[1][1])
+            distance_to_segment = haversine_distance(lng, lat, snapped_to_segment[0], snapped_to_segment[1])
+            snapped_to_next_segment = snap(lng, lat, next_segment[0][0], next_segment[0][1], next_segment[1][0], next_segment[1][1])
+            distance_to_next_segment = haversine_distance(lng, lat, snapped_to_next_segment[0], snapped_to_next_segment[1])
+            if distance_to_segment < distance_to_next_segment:
+                gps_point_idx += 1
+            else:
+                break
+        snapped_segments.append((segment, speeds[first_gps_point_idx:gps_point_idx].tolist(), list(range(first_gps_point_idx, gps_point_idx))))
+    return snapped_segments
+
+def assert_same_snapping(points, longitudes, latitudes, speeds):
+    expected = snap_track_scalar(points, longitudes, latitudes, speeds)
+    actual = [(segment, speeds_on_segment, list(gps_point_indices)) for segment, speeds_on_segment, gps_point_indices in snap_track(points, longitudes, latitudes, speeds)]
+    assert actual == expected
+
+def random_track(rng, segment_count, gps_point_count, noise=2e-4):
+    # A random walk as map matched path, with noisy GPS points along it
+    steps = rng.normal(0, 1e-3, size=(segment_count, 2))
+    path = np.vstack([[13.7, 51.05], np.array([13.7, 51.05]) + np.cumsum(steps, axis=0)])
+    fractions = np.sort(rng.uniform(0, segment_count, size=gps_point_count))
+    rows = np.minimum(fractions.astype(int), segment_count - 1)
+    along = fractions - rows
+    gps = path[rows] + (path[rows + 1] - path[rows]) * along[:, np.newaxis] + rng.normal(0, noise, size=(gps_point_count, 2))
+    points = [[lng, lat] for lng, lat in path.tolist()]
+    return points, np.ascontiguousarray(gps[:, 0]), np.ascontiguousarray(gps[:, 1]), rng.uniform(0, 10, size=gps_point_count)
+
+@pytest.mark.parametrize("seed", range(200))
+def test_random_tracks(seed):
+    rng = np.random.default_rng(seed)
+    points, longitudes, latitudes, speeds = random_track(rng, int(rng.integers(1, 60)), int(rng.integers(0, 400)), noise=float(rng.choice([0, 2e-5, 2e-4, 2e-3])))
+    assert_same_snapping(points, longitudes, latitudes, speeds)
+
+@pytest.mark.parametrize("gps_point_count", [0, 1, 2, 3])
+def test_few_gps_points(gps_point_count):
+    rng = np.random.default_rng(gps_point_count)
+    points, longitudes, latitudes, speeds = random_track(rng, 10, gps_point_count)
+    assert_same_snapping(points, longitudes, latitudes, speeds)
+
+@pytest.mark.parametrize("point_count", [0, 1, 2, 3, 4])
+def test_short_paths(point_count):
+    rng = np.random.default_rng(point_count)
+    points, longitudes, latitudes, speeds = random_track(rng, 10, 50)
+    assert_same_snapping(points[:point_count], longitudes, latitudes, speeds)
+
+def test_repeated_gps_points():
+    rng = np.random.default_rng(1)
+    points, longitudes, latitudes, speeds = random_track(rng, 20, 100)
+    # A stationary track and a track that stops halfway
+    assert_same_snapping(points, np.full(100, longitudes[0]), np.full(100, latitudes[0]), speeds)
+    assert_same_snapping(points, np.repeat(longitudes[:50], 2), np.repeat(latitudes[:50], 2), speeds)
+
+def test_zero_length_segments():
+    rng = np.random.default_rng(2)
+    points, longitudes, latitudes, speeds = random_track(rng, 20, 200)
+    # Every path point twice, and a path that never moves
+    assert_same_snapping([point for point in points for _ in range(2)], longitudes, latitudes, speeds)
+    assert_same_snapping([points[0]] * 10, longitudes, latitudes, speeds)
+
+def test_large_gps_gaps():
+    # Many points on few segments, which needs the window of snap_track to grow
+    rng = np.random.default_rng(3)
+    points, longitudes, latitudes, speeds = random_track(rng, 8, 3000, noise=1e-5)
+    assert_same_snapping(points, longitudes, latitudes, speeds)
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+from lib.buckets import DURATION_UNITS_MS
+from lib.layers import AggregateStore
+from lib.segments import SegmentTable
+from lib.speeds import speed_aggregate_factory
+from lib.store import SqliteSegmentStore
+
+DAY = DURATION_UNITS_MS["d"]
+
+def random_bucket(create_speed_aggregate, seed):
+    # Overlapping segments across the buckets, so the layers merge counts and speeds
+    rng = np.random.default_rng(seed)
+    segments = SegmentTable(create_speed_aggregate)
+    for _ in range(200):
+        start = np.round(rng.uniform([13.70, 51.00], [13.72, 51.02]), 3)
+        segment = ((start[0], start[1]), (start[0] + 0.001, start[1]))
+        segments.add_traversal(segment)
+        segments.add_speeds(segment, ["citybike", "racingbike"][int(rng.integers(2))], rng.uniform(1, 9, int(rng.integers(1, 4))).tolist())
+    return segments
+
+def layers_json(aggregate_store):
+    layers = {}
+    for name, (segments, start_time, end_time) in aggregate_store.update_layers().items():
+        if isinstance(segments, SqliteSegmentStore):
+            layers[name] = (segments.load().to_json(), start_time, end_time)
+            segments.close()
+        else:
+            layers[name] = (segments.to_json(), start_time, end_time)
+    return layers
+
+@pytest.mark.parametrize("batch_size", [7, 50000])
+def test_store_layers_are_the_same_as_in_memory(tmp_path, batch_size):
+    create_speed_aggregate = speed_aggregate_factory("exact")
+    in_memory = AggregateStore(str(tmp_path / "memory"), create_speed_aggregate=create_speed_aggregate)
+    on_disk = AggregateStore(str(tmp_path / "sqlite"), create_speed_aggregate=create_speed_aggregate, batch_size=batch_size)
+    # Two runs, the second one merges new buckets and drops the first ones out of the rolling layers
+    for days in (range(3), range(3, 10)):
+        for day in days:
+            in_memory.save_bucket(random_bucket(create_speed_aggregate, day), day * DAY, (day + 1) * DAY)
+            store = SqliteSegmentStore.create(str(tmp_path / "segments.sqlite"), create_speed_aggregate, batch_size=batch_size)
+            store.upsert(random_bucket(create_speed_aggregate, day))
+            store.commit()
+            on_disk.save_bucket(store, day * DAY, (day + 1) * DAY)
+            store.remove()
+        assert layers_json(on_disk) == layers_json(in_memory)
+    assert sorted(path.name for path in (tmp_path / "sqlite" / "layers").iterdir()) == sorted(f"{name}.{extension}" for name in ("daily", "weekly", "monthly", "all_time") for extension in ("pkl", "sqlite"))
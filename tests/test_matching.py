@@ -0,0 +1,55 @@
+import pytest
+import requests
+from lib.matching import MapMatcher
+
+class ScriptedSession:
+    """
+    Session whose post raises the scripted exceptions or returns the
+    scripted responses in order.
+    """
+    def __init__(self, results):
+        self.results = list(results)
+        
+    def post(self, url, data=None, headers=None, timeout=None):
+        result = self.results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+    
+    def close(self):
+        pass
+
+def response(status_code, body):
+    result = requests.Response()
+    result.status_code = status_code
+    result._content = body
+    return result
+
+def scripted_matcher(results, retries=3):
+    map_matcher = MapMatcher("http://graphhopper", max_concurrency=4, retries=retries, backoff_factor=0)
+    map_matcher.session = ScriptedSession(results)
+    return map_matcher
+
+@pytest.mark.parametrize("error", [requests.Timeout(), requests.ConnectionError(), requests.exceptions.ChunkedEncodingError()])
+def test_request_errors_are_retried(error):
+    map_matcher = scripted_matcher([error, response(200, b'{"paths": []}')])
+    assert map_matcher.match("<gpx></gpx>") == {"paths": []}
+    assert map_matcher.limit.in_flight == 0
+    assert map_matcher.failed_request_count == 1
+
+def test_failed_requests_release_their_slot():
+    map_matcher = scripted_matcher([requests.exceptions.ChunkedEncodingError()] * 2, retries=1)
+    assert map_matcher.match("<gpx></gpx>") == {}
+    assert map_matcher.limit.in_flight == 0
+    assert map_matcher.request_count == 2
+
+@pytest.mark.parametrize("status_code", [429, 503])
+def test_throttled_and_server_errors_are_retried(status_code):
+    map_matcher = scripted_matcher([response(status_code, b"<html></html>"), response(200, b'{"paths": []}')])
+    assert map_matcher.match("<gpx></gpx>") == {"paths": []}
+    assert map_matcher.limit.in_flight == 0
+
+def test_client_errors_without_json_are_errors():
+    map_matcher = scripted_matcher([response(404, b"<html></html>")])
+    response_data = map_matcher.match("<gpx></gpx>")
+    assert "paths" not in response_data and "404" in response_data["message"]
@@ -0,0 +1,76 @@
+import multiprocessing
+import numpy as np
+import pytest
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from lib.output import SegmentProcessingOutput
+from lib.pipeline import batched, ordered_map
+from lib.speeds import speed_aggregate_factory
+from lib.tracks import Track
+from process import snap_batch, snap_to_segments
+
+BIKE_TYPES = ["citybike", "racingbike", "ebike"]
+
+def random_tracks(seed, track_count=60):
+    """
+    Map matched tracks on a small street grid, so that the tracks share
+    segments. Every item is (track_idx, track, points, track_debugger) like
+    in process_segments, and every 7th track counts as map matching error.
+    """
+    rng = np.random.default_rng(seed)
+    tracks = []
+    for track_idx in range(track_count):
+        nodes = [rng.integers(0, 10, size=2)]
+        for _ in range(int(rng.integers(2, 12))):
+            nodes.append(nodes[-1] + [(1, 0), (-1, 0), (0, 1), (0, -1)][int(rng.integers(4))])
+        points = [[13.70 + 0.001 * x, 51.03 + 0.001 * y] for x, y in np.array(nodes).tolist()]
+        fractions = np.sort(rng.uniform(0, len(points) - 1, int(rng.integers(2, 60))))
+        path = np.array(points)
+        gps_points = path[fractions.astype(int)] + (fractions % 1)[:, None] * (path[np.minimum(fractions.astype(int) + 1, len(points) - 1)] - path[fractions.astype(int)])
+        gps_points += rng.normal(0, 1e-5, gps_points.shape)
+        track = Track(track_idx, "session", "user", BIKE_TYPES[int(rng.integers(len(BIKE_TYPES)))], gps_points[:, 0], gps_points[:, 1], rng.uniform(0, 10, len(gps_points)))
+        tracks.append((track_idx, track, points, None))
+    return tracks
+
+def count_errors(output, batch):
+    for track_idx, _, _, _ in batch:
+        if track_idx % 7 == 0:
+            output.tracks_with_map_matching_error_count += 1
+
+def single_output(create_speed_aggregate, tracks):
+    output = SegmentProcessingOutput(create_speed_aggregate=create_speed_aggregate)
+    for _, track, points, track_debugger in tracks:
+        snap_to_segments(output, track, points, track_debugger)
+    count_errors(output, tracks)
+    return output
+
+def assert_same_output(output, other_output):
+    assert other_output.tracks_with_map_matching_error_count == output.tracks_with_map_matching_error_count
+    segments = output.get_processed_segments()
+    other_segments = other_output.get_processed_segments()
+    # The segments are in the same order, not only the same
+    assert list(other_segments.to_json().items()) == list(segments.to_json().items())
+    np.testing.assert_array_equal(other_segments.coordinates, segments.coordinates)
+    np.testing.assert_array_equal(other_segments.traversal_counts, segments.traversal_counts)
+
+@pytest.mark.parametrize("batch_size", [1, 7, 32])
+def test_merged_batches_are_the_same_as_one_output(batch_size):
+    create_speed_aggregate = speed_aggregate_factory("exact")
+    tracks = random_tracks(batch_size)
+    merged_output = SegmentProcessingOutput(create_speed_aggregate=create_speed_aggregate)
+    for batch in batched(tracks, batch_size):
+        batch_output, batch_pks, _, _ = snap_batch(create_speed_aggregate, batch)
+        assert batch_pks == [track.pk for _, track, _, _ in batch]
+        count_errors(batch_output, batch)
+        merged_output.merge(batch_output)
+    assert_same_output(single_output(create_speed_aggregate, tracks), merged_output)
+
+def test_worker_processes_are_the_same_as_one_output():
+    create_speed_aggregate = speed_aggregate_factory("exact")
+    tracks = random_tracks(0)
+    merged_output = SegmentProcessingOutput(create_speed_aggregate=create_speed_aggregate)
+    with ProcessPoolExecutor(max_workers=2, mp_context=multiprocessing.get_context("forkserver")) as executor:
+        for batch_output, _, _, _ in ordered_map(executor, partial(snap_batch, create_speed_aggregate), batched(tracks, 5), max_pending=4):
+            merged_output.merge(batch_output)
+    count_errors(merged_output, tracks)
+    assert_same_output(single_output(create_speed_aggregate, tracks), merged_output)
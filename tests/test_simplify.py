@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+from lib.simplify import drop_stationary_points
+
+@pytest.mark.parametrize("min_distance", [0, 1.5, 3])
+def test_indices_are_unique_and_increasing(min_distance):
+    rng = np.random.default_rng(0)
+    x, y = np.cumsum(rng.normal(0, 2, (2, 200)), axis=1)
+    indices = drop_stationary_points(x, y, min_distance)
+    assert indices[0] == 0 and indices[-1] == len(x) - 1
+    assert (np.diff(indices) > 0).all()
+
+def test_zero_distance_keeps_every_point():
+    x = np.array([0.0, 0.0, 1.0, 5.0])
+    y = np.zeros(4)
+    np.testing.assert_array_equal(drop_stationary_points(x, y, 0), [0, 1, 2, 3])
+
+def test_stationary_points_are_dropped():
+    x = np.array([0.0, 1.0, 2.0, 4.0, 4.5, 5.0])
+    y = np.zeros(6)
+    np.testing.assert_array_equal(drop_stationary_points(x, y, 3), [0, 3, 5])
+
+def test_single_point():
+    np.testing.assert_array_equal(drop_stationary_points(np.zeros(1), np.zeros(1), 3), [0])
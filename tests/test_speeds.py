@@ -0,0 +1,47 @@
+import math
+import numpy as np
+import pytest
+from lib.speeds import ExactSpeeds, SpeedHistogram, speed_aggregate_factory
+
+NAN = float("nan")
+
+@pytest.mark.parametrize("mode", ["histogram", "exact"])
+def test_nan_speeds_are_dropped(mode):
+    speeds = speed_aggregate_factory(mode)()
+    # Enough samples to compact the histogram
+    speeds.add([NAN] + [3.0] * 60 + [math.inf])
+    assert speeds.count() == 60
+    assert speeds.median() == pytest.approx(3.0, abs=0.125)
+
+def test_nan_speeds_are_dropped_when_merged():
+    speeds = SpeedHistogram()
+    speeds.add([3.0] * 60)
+    other = SpeedHistogram()
+    other.add([NAN, 4.0])
+    speeds.merge(other)
+    assert speeds.count() == 61
+    other = SpeedHistogram()
+    other.add([NAN, 5.0])
+    other.merge(speeds)
+    assert other.count() == 62
+
+def test_only_nan_speeds():
+    speeds = SpeedHistogram()
+    speeds.add([NAN, NAN])
+    assert speeds.count() == 0
+    assert speeds.to_json() == []
+
+def test_negative_and_fast_speeds_are_counted_in_the_outer_bins():
+    speeds = SpeedHistogram(bin_width=0.25, max_speed=25.0)
+    speeds.add([-1.0] * 30 + [40.0] * 30)
+    assert speeds.count() == 60
+    assert speeds.to_json()["bins"] == {"0.125": 30, "24.875": 30}
+
+def test_histogram_median_is_within_half_a_bin():
+    rng = np.random.default_rng(0)
+    samples = rng.uniform(0, 10, 1000)
+    speeds = SpeedHistogram(bin_width=0.25)
+    speeds.add(samples)
+    exact = ExactSpeeds()
+    exact.add(samples)
+    assert speeds.median() == pytest.approx(exact.median(), abs=0.125)
@@ -0,0 +1,42 @@
+import pytest
+from lib.output import SegmentProcessingOutput
+from lib.speeds import speed_aggregate_factory
+from lib.store import SqliteSegmentStore
+from process import anonymize_segments, create_geojson_output, load_segments, snap_to_segments
+from test_output import random_tracks, single_output
+
+def store_output(create_speed_aggregate, tracks, path, batch_size):
+    # Small flush and batch sizes, so the segments are upserted and read in many batches
+    store = SqliteSegmentStore.create(path, create_speed_aggregate, batch_size=batch_size)
+    output = SegmentProcessingOutput(create_speed_aggregate=create_speed_aggregate, store=store, flush_size=batch_size)
+    for _, track, points, track_debugger in tracks:
+        snap_to_segments(output, track, points, track_debugger)
+    return output
+
+@pytest.mark.parametrize("mode", ["exact", "histogram"])
+@pytest.mark.parametrize("batch_size", [1, 5, 50000])
+def test_store_is_the_same_as_in_memory(tmp_path, mode, batch_size):
+    create_speed_aggregate = speed_aggregate_factory(mode)
+    tracks = random_tracks(batch_size)
+    segments = single_output(create_speed_aggregate, tracks).get_processed_segments()
+    store = store_output(create_speed_aggregate, tracks, str(tmp_path / "segments.sqlite"), batch_size).get_processed_segments()
+    assert isinstance(store, SqliteSegmentStore)
+    assert len(store) == len(segments)
+    assert list(store.load().to_json().items()) == list(segments.to_json().items())
+    # Streaming the tables gives the same segments in the same order
+    streamed = [key for table in store.tables() for key in table.to_json()]
+    assert streamed == list(segments.to_json())
+    
+    anonymized_segments = anonymize_segments(segments)
+    anonymized_store = anonymize_segments(store)
+    assert len(anonymized_segments) > 0
+    assert list(load_segments(anonymized_store).to_json().items()) == list(anonymized_segments.to_json().items())
+    
+    for stitch_speed_tolerance in (None, 1.0):
+        path = tmp_path / "memory.json"
+        store_path = tmp_path / "store.json"
+        create_geojson_output(anonymized_segments, 0, 1, path=str(path), stitch_speed_tolerance=stitch_speed_tolerance, compress=False)
+        create_geojson_output(anonymized_store, 0, 1, path=str(store_path), stitch_speed_tolerance=stitch_speed_tolerance, compress=False)
+        assert store_path.read_bytes() == path.read_bytes()
+    store.remove()
+    anonymized_store.remove()
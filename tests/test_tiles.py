@@ -0,0 +1,38 @@
+import numpy as np
+import pytest
+from lib.segments import SegmentTable
+from lib.speeds import speed_aggregate_factory
+from lib.tiles import tile_indices, tile_positions, tile_segments
+
+def sampled_tiles(segment, zoom, sample_count=5000):
+    # The tiles of many points along the segment, straight in web mercator
+    (start_lng, start_lat), (end_lng, end_lat) = segment
+    start_x, start_y = tile_positions(start_lng, start_lat, zoom)
+    end_x, end_y = tile_positions(end_lng, end_lat, zoom)
+    fractions = np.linspace(0, 1, sample_count)
+    x, y = tile_indices(start_x + fractions * (end_x - start_x), start_y + fractions * (end_y - start_y), zoom)
+    return set(zip(x.tolist(), y.tolist()))
+
+@pytest.mark.parametrize("zoom", [10, 14, 16])
+def test_segments_are_in_every_tile_they_pass(zoom):
+    rng = np.random.default_rng(zoom)
+    segments = SegmentTable(speed_aggregate_factory())
+    for _ in range(300):
+        start = rng.uniform([13.6, 50.9], [13.9, 51.2])
+        end = start + rng.normal(0, 0.01, size=2)
+        segments.add_traversal(((start[0], start[1]), (end[0], end[1])))
+    
+    tiles = tile_segments(segments, np.arange(len(segments)), zoom)
+    for segment_id in range(len(segments)):
+        segment = segments.segment(segment_id)
+        expected = sampled_tiles(segment, zoom)
+        actual = {tile for tile, tile_segment_ids in tiles.items() if segment_id in tile_segment_ids}
+        assert actual == expected
+
+def test_long_segment_is_in_the_tiles_in_between():
+    segments = SegmentTable(speed_aggregate_factory())
+    segments.add_traversal(((13.70, 51.05), (13.80, 51.05)))
+    tiles = tile_segments(segments, [0], 16)
+    start_x, y = tile_indices(*tile_positions(13.70, 51.05, 16), 16)
+    end_x, _ = tile_indices(*tile_positions(13.80, 51.05, 16), 16)
+    assert sorted(tiles) == [(x, int(y)) for x in range(int(start_x), int(end_x) + 1)]
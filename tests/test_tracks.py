@@ -0,0 +1,58 @@
+import numpy as np
+import pandas as pd
+import pytest
+from io import StringIO
+from lib.tracks import INVALID_COORDINATES, MISSING_COLUMNS, TOO_SHORT, parse_gps_csv
+
+def assert_parsed_like_pandas(gps_csv):
+    longitudes, latitudes, speeds, timestamps, error = parse_gps_csv(gps_csv)
+    assert error is None
+    gps_data = pd.read_csv(StringIO(gps_csv))
+    np.testing.assert_array_equal(longitudes, gps_data["longitude"])
+    np.testing.assert_array_equal(latitudes, gps_data["latitude"])
+    np.testing.assert_array_equal(speeds, gps_data["speed"])
+    return timestamps
+
+def test_plain_csv():
+    timestamps = assert_parsed_like_pandas("latitude,longitude,speed,timestamp\n51.05,13.7,3.5,1700000000000\n51.06,13.71,4.0,1700000001000\n")
+    np.testing.assert_array_equal(timestamps, [1700000000000, 1700000001000])
+
+@pytest.mark.parametrize("gps_csv", [
+    '"latitude","longitude","speed","timestamp"\n51.05,13.7,3.5,1700000000000\n51.06,13.71,4.0,1700000001000\n',
+    '"latitude","longitude","speed","timestamp"\n"51.05","13.7","3.5","1700000000000"\n"51.06","13.71","4.0","1700000001000"\n',
+])
+def test_quoted_csv(gps_csv):
+    timestamps = assert_parsed_like_pandas(gps_csv)
+    np.testing.assert_array_equal(timestamps, [1700000000000, 1700000001000])
+
+def test_missing_timestamps_are_dropped():
+    timestamps = assert_parsed_like_pandas("latitude,longitude,speed,timestamp\n51.05,13.7,3.5,\n51.06,13.71,4.0,1700000001000\n")
+    assert timestamps is None
+
+def test_points_without_speed_are_dropped():
+    longitudes, latitudes, speeds, timestamps, error = parse_gps_csv("latitude,longitude,speed,timestamp\n51.05,13.7,,1000\n51.06,13.71,4.0,2000\n51.07,13.72,nan,3000\n51.08,13.73,5.0,4000\n")
+    assert error is None
+    np.testing.assert_array_equal(longitudes, [13.71, 13.73])
+    np.testing.assert_array_equal(latitudes, [51.06, 51.08])
+    np.testing.assert_array_equal(speeds, [4.0, 5.0])
+    np.testing.assert_array_equal(timestamps, [2000, 4000])
+
+@pytest.mark.parametrize("gps_csv", [
+    "latitude,longitude,speed\n51.05,,3.5\n51.06,13.71,4.0\n",
+    "latitude,longitude,speed\nnan,13.7,3.5\n51.06,13.71,4.0\n",
+])
+def test_missing_coordinates_are_invalid(gps_csv):
+    assert parse_gps_csv(gps_csv)[4] == INVALID_COORDINATES
+
+@pytest.mark.parametrize("gps_csv, error", [
+    ("", TOO_SHORT),
+    ("latitude,longitude,speed\n", TOO_SHORT),
+    ("latitude,longitude,speed\n51.05,13.7,3.5\n", TOO_SHORT),
+    # Only one point with a speed is left
+    ("latitude,longitude,speed\n51,13,\n51.1,13.1,3\n", TOO_SHORT),
+    # Too short is counted before missing columns
+    ("latitude,speed\n51.05,3.5\n", TOO_SHORT),
+    ("latitude,speed\n51.05,3.5\n51.06,4.0\n", MISSING_COLUMNS),
+])
+def test_errors(gps_csv, error):
+    assert parse_gps_csv(gps_csv)[4] == error